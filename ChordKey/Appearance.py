@@ -415,13 +415,79 @@ class ColorScheme(object):
 
     COLOR_SCHEME_FORMAT = COLOR_SCHEME_WINDOW_COLORS
 
+    # key states, bit i of a packed state is the value of KEY_STATES[i],
+    # bit i + len(KEY_STATES) tells if the state dict had that entry.
+    KEY_STATES = ("prelight", "pressed", "active",
+                  "locked", "scanned", "insensitive")
+
     name = ""
     filename = ""
     is_system = False
     root = None       # tree root
 
     def __init__(self):
-        pass
+        self._key_groups = {}            # key id: KeyGroup
+        self._default_key_group = None
+        self._rgba_table = {}            # (theme_id, id, element, packed state): rgba
+
+    def compile(self):
+        """
+        Flatten the key group tree into a lookup by key id and drop all
+        resolved colors. Call this whenever root was replaced.
+        """
+        key_groups = {}
+        def add_key_groups(item):
+            for child in item.items:
+                if child.is_key_group():
+                    for key_id in child.key_ids:
+                        key_groups.setdefault(key_id, child)
+                add_key_groups(child)
+
+        if self.root:
+            add_key_groups(self.root)
+            self._default_key_group = self.root.get_default_key_group()
+        else:
+            self._default_key_group = None
+        self._key_groups = key_groups
+        self._rgba_table = {}
+
+    @classmethod
+    def pack_state(cls, state):
+        """ Packed state bitmask of a state dict """
+        packed = 0
+        n = len(cls.KEY_STATES)
+        for i, name in enumerate(cls.KEY_STATES):
+            if name in state:
+                packed |= 1 << (i + n)
+                if state[name]:
+                    packed |= 1 << i
+        return packed
+
+    @classmethod
+    def unpack_state(cls, packed):
+        """ State dict of a packed state bitmask """
+        n = len(cls.KEY_STATES)
+        return dict((name, bool(packed & (1 << i))) \
+                    for i, name in enumerate(cls.KEY_STATES) \
+                    if packed & (1 << (i + n)))
+
+    @staticmethod
+    def _pack_key_state(key):
+        """ Packed current state of key, in KEY_STATES order """
+        packed = 0xfc0   # all states present
+        if key.prelight:
+            packed |= 1
+        if key.pressed:
+            packed |= 2
+        if key.active:
+            packed |= 4
+        if key.locked:
+            packed |= 8
+        if key.scanned:
+            packed |= 16
+        if not key.sensitive:
+            packed |= 32
+        return packed
 
     @property
     def basename(self):
@@ -430,7 +496,7 @@ class ColorScheme(object):
 
     def is_key_in_schema(self, key):
         for id in [key.theme_id, key.id]:
-            if self.root.find_key_id(id):
+            if id in self._key_groups:
                 return True
         return False
 
@@ -438,17 +504,26 @@ class ColorScheme(object):
         """
         Get the color for the given key element and optionally key state.
         If state is None, the key state is taken from the key itself.
-        """
 
+        Colors are resolved once per key id, element and state, later
+        calls are a single dict lookup. Don't modify the returned list.
+        """
         if state is None:
-            state = {}
-            state["prelight"]    =  key.prelight
-            state["pressed"]     =  key.pressed
-            state["active"]      =  key.active
-            state["locked"]      =  key.locked
-            state["scanned"]     =  key.scanned
-            state["insensitive"] =  not key.sensitive
+            packed = self._pack_key_state(key)
+        else:
+            packed = self.pack_state(state)
+
+        table_key = (key.theme_id, key.id, element, packed)
+        rgba = self._rgba_table.get(table_key)
+        if rgba is None:
+            if state is None:
+                state = self.unpack_state(packed)
+            rgba = self._resolve_key_rgba(key, element, state)
+            self._rgba_table[table_key] = rgba
+        return rgba
 
+    def _resolve_key_rgba(self, key, element, state):
+        """ Walk the color scheme for the color of a key element """
         rgb = None
         opacity = None
         root_rgb = None
@@ -457,14 +532,14 @@ class ColorScheme(object):
 
         # first try to find the theme_id then fall back to the generic id
         for id in [key.theme_id, key.id]:
-            key_group = self.root.find_key_id(id)
+            key_group = self._key_groups.get(id)
             if key_group:
                 rgb, opacity = key_group.find_element_color(element, state)
                 break
 
         # Get root colors as fallback for the case when key id
         # wasn't mentioned anywhere in the color scheme.
-        root_key_group = self.root.get_default_key_group()
+        root_key_group = self._default_key_group
         if root_key_group:
             root_rgb, root_opacity = \
                     root_key_group.find_element_color(element, state)
@@ -783,6 +858,7 @@ class ColorScheme(object):
                 color_scheme.filename = filename
                 color_scheme.is_system = is_system
                 color_scheme.root = root
+                color_scheme.compile()
                 #print(root.dumps())
         except xml.parsers.expat.ExpatError as ex:
             _logger.error(_format("Error loading color scheme '{filename}'. "
@@ -18,15 +18,11 @@ import dbus.mainloop.glib
 
 from gi.repository import GLib, Gdk, Gtk
 
-import virtkey
-
 from ChordKey.KbdWindow       import KbdWindow, KbdPlugWindow
 from ChordKey.Keyboard        import ChordKeyboard
 from ChordKey.ChordKeyboardWidget  import ChordKeyboardWidget
-from ChordKey.Indicator       import Indicator
-#from ChordKey.LayoutLoaderSVG import LayoutLoaderSVG
-from ChordKey.Appearance      import ColorScheme
-from ChordKey.IconPalette     import IconPalette
+from ChordKey.LatencyTracer   import get_latency_tracer
+from ChordKey.StartupProfile  import get_startup_profile
 from ChordKey.utils           import show_confirmation_dialog, CallOnce, Process, \
                                     unicode_str
 import ChordKey.osk as osk
@@ -42,6 +38,8 @@ app = "chordkey"
 app_upper = "ChordKey"
 DEFAULT_FONTSIZE = 10
 
+startup_profile = get_startup_profile()
+
 
 class ChordKeyGtk(object):
     """
@@ -51,6 +49,8 @@ class ChordKeyGtk(object):
     DBUS_NAME = "org.chordkey.ChordKey"
 
     keyboard = None
+    _virtkey = None     # virtkey module, imported on first use
+    _first_draw_id = None   # handler starting init_deferred()
 
     def __init__(self):
 
@@ -65,6 +65,8 @@ class ChordKeyGtk(object):
         bus = dbus.SessionBus()
         has_remote_instance = bus.name_has_owner(self.DBUS_NAME)
 
+        startup_profile.mark("single instance check")
+
         # Embedded instances can't become primary instances
         if has_remote_instance and \
            not config.options.allow_multiple_instances:
@@ -84,6 +86,11 @@ class ChordKeyGtk(object):
 
 
     def init(self):
+        """
+        Get the keyboard window mapped as early as possible.
+        Everything it doesn't need for the first frame is left
+        to init_deferred().
+        """
         self.keyboard_state = None
         self.vk_timer = None
         self.reset_vk()
@@ -94,6 +101,7 @@ class ChordKeyGtk(object):
 
         # finish config initialization
         config.init()
+        startup_profile.mark("config")
 
         # Release pressed keys when onboard is killed.
         # Don't keep enter key stuck when being killed from lightdm.
@@ -103,25 +111,21 @@ class ChordKeyGtk(object):
 
         # Create the central keyboard model
         self.keyboard = ChordKeyboard()
-        
+        startup_profile.mark("keyboard")
+
         # Create the initial keyboard widget
         # Care for toolkit independence only once there is another
         # supported one besides GTK.
         self.keyboard_widget = ChordKeyboardWidget(self.keyboard)
 
-        icp = IconPalette()
-        icp.set_layout_view(self.keyboard_widget)
-        icp.connect("activated", self._on_icon_palette_acticated)
-
-        self._window = KbdWindow(self.keyboard_widget, icp)
+        # The icon palette is created later, see init_deferred().
+        self._window = KbdWindow(self.keyboard_widget, None)
         self.do_connect(self._window, "quit-onboard",
                         lambda x: self.do_quit_onboard())
 
         self._window.application = self
         config.main_window = self._window # need this to access screen properties
 
-        self.load_vk()
-
         # Handle command line options x, y, size after window creation
         # because the rotation code needs the window's screen.
         if not config.xid_mode:
@@ -144,17 +148,17 @@ class ChordKeyGtk(object):
                 self._window.write_window_rect(orientation, rect)
                 self._window.restore_window_rect() # move/resize early
 
-        # export dbus service
-        if not config.xid_mode:
-            self.service_keyboard = ServiceOnboardKeyboard(self.keyboard_widget)
+        # Minimize to IconPalette if running under GDM
+        if 'RUNNING_UNDER_GDM' in os.environ:
+            config.icp.in_use = True
+            config.show_status_icon = False
+
+        # unity-2d needs the skip-task-bar hint set before the first mapping.
+        self.show_hide_taskbar()
 
         # show/hide the window
         self.keyboard_widget.set_startup_visibility()
-
-        # keep keyboard window and icon palette on top of dash
-        if not config.xid_mode: # be defensive, not necessary when embedding
-            self._osk_util.keep_windows_on_top([self._window,
-                                                self._window.icp])
+        startup_profile.mark("window")
 
         # connect notifications for keyboard map and group changes
         self.keymap = Gdk.Keymap.get_default()
@@ -224,29 +228,86 @@ class ChordKeyGtk(object):
             if config.mousetweaks:
                 config.mousetweaks.state_notify_add(update_ui)
 
-        # create status icon
-        self.status_icon = Indicator()
-        self.status_icon.set_keyboard_window(self._window)
-        self.do_connect(self.status_icon, "quit-onboard",
-                        lambda x: self.do_quit_onboard())
-
         # Callbacks to use when icp or status icon is toggled
         if 0: #FIXME
             config.show_status_icon_notify_add(self.show_hide_status_icon)
             config.icp.in_use_notify_add(self.cb_icp_in_use_toggled)
 
-        self.show_hide_status_icon(config.show_status_icon)
+        # The rest waits until the keyboard has been drawn once,
+        # unless it starts hidden and there is no frame to wait for.
+        if config.is_visible_on_start():
+            self._first_draw_id = self.keyboard_widget.connect_after(
+                                        "draw", self._on_first_draw)
+        else:
+            GLib.idle_add(self.init_deferred)
 
+    def _on_first_draw(self, widget, context):
+        """
+        The first frame was drawn, start the second stage from
+        the main loop, so the frame reaches the screen first.
+        """
+        widget.disconnect(self._first_draw_id)
+        self._first_draw_id = None
+        GLib.idle_add(self.init_deferred)
+        return False
 
-        # Minimize to IconPalette if running under GDM
-        if 'RUNNING_UNDER_GDM' in os.environ:
-            config.icp.in_use = True
-            config.show_status_icon = False
+    def init_deferred(self):
+        """
+        Second startup stage, set up everything the first frame
+        didn't need. Optional subsystems are only loaded when enabled.
+        """
+        # key synthesis, the keyboard is usable from here on
+        self.load_vk()
+        startup_profile.mark("virtkey")
 
-        # unity-2d needs the skip-task-bar hint set before the first mapping.
-        self.show_hide_taskbar()
+        # export dbus service
+        if not config.xid_mode:
+            self.service_keyboard = ServiceOnboardKeyboard(self.keyboard_widget)
+            startup_profile.mark("dbus service")
 
+        if config.is_icon_palette_in_use():
+            self.get_icon_palette()
+            startup_profile.mark("icon palette")
 
+        self.show_hide_status_icon(config.show_status_icon)
+        startup_profile.mark("status icon")
+
+        if config.is_auto_show_enabled():
+            self.keyboard_widget.auto_show.enable(True)
+            startup_profile.mark("auto-show")
+
+        self.keep_windows_on_top()
+        startup_profile.finish(config.options.profile_startup)
+        return False
+
+    def get_icon_palette(self):
+        """ The icon palette, created on first use """
+        if not self._window.icp:
+            from ChordKey.IconPalette import IconPalette
+            icp = IconPalette()
+            icp.set_layout_view(self.keyboard_widget)
+            icp.connect("activated", self._on_icon_palette_acticated)
+            self._window.icp = icp
+            self.keep_windows_on_top()
+        return self._window.icp
+
+    def get_status_icon(self):
+        """ The status icon, created on first use """
+        if not self.status_icon:
+            from ChordKey.Indicator import Indicator
+            self.status_icon = Indicator()
+            self.status_icon.set_keyboard_window(self._window)
+            self.do_connect(self.status_icon, "quit-onboard",
+                            lambda x: self.do_quit_onboard())
+        return self.status_icon
+
+    def keep_windows_on_top(self):
+        """ keep keyboard window and icon palette on top of dash """
+        if not config.xid_mode: # be defensive, not necessary when embedding
+            windows = [self._window]
+            if self._window.icp:
+                windows.append(self._window.icp)
+            self._osk_util.keep_windows_on_top(windows)
 
     def on_sigterm(self):
         """
@@ -292,8 +353,10 @@ class ChordKeyGtk(object):
         _logger.debug("Leaving on_icp_in_use_toggled")
 
     def show_hide_icp(self):
+        show = config.is_icon_palette_in_use()
+        if show:
+            self.get_icon_palette()
         if self._window.icp:
-            show = config.is_icon_palette_in_use()
             if show:
                 # Show icon palette if appropriate and handle visibility of taskbar.
                 if not self._window.is_visible():
@@ -313,8 +376,8 @@ class ChordKeyGtk(object):
         handles the showing/hiding of the taskar.
         """
         if show_status_icon:
-            self.status_icon.set_visible(True)
-        else:
+            self.get_status_icon().set_visible(True)
+        elif self.status_icon:
             self.status_icon.set_visible(False)
         self.show_hide_icp()
         self.show_hide_taskbar()
@@ -338,7 +401,8 @@ class ChordKeyGtk(object):
         _logger.debug("keyboard state changed to 0x{:x}" \
                       .format(keymap.get_modifier_state()))
         mod_mask = keymap.get_modifier_state()
-        self.keyboard.set_modifiers(mod_mask)
+        if self.keyboard.set_modifiers(mod_mask):
+            self.keyboard_widget.redraw_all()
 
     def cb_vk_timer(self):
         """
@@ -351,8 +415,9 @@ class ChordKeyGtk(object):
         return True
 
     def _update_ui(self):
-        self.keyboard.update_ui()
-        self.keyboard.redraw()
+        config.update_render_settings()
+        self.keyboard_widget.update_ui()
+        self.keyboard_widget.queue_draw()
 
     def _update_window_options(self, value = None):
         window = self._window
@@ -391,6 +456,8 @@ class ChordKeyGtk(object):
 
     def on_theme_changed(self, theme):
         config.apply_theme()
+        config.update_render_settings()
+        self.keyboard_widget.invalidate_label_extents()
         self.reload_layout()
 
     def reload_layout_and_present(self):
@@ -414,7 +481,7 @@ class ChordKeyGtk(object):
                 vk.reload() # reload keyboard names
                 keyboard_state = (vk.get_layout_symbols(),
                                   vk.get_current_group_name())
-            except virtkey.error:
+            except self._virtkey.error:
                 self.reset_vk()
                 force_update = True
                 _logger.warning("Keyboard layout changed, but retrieving "
@@ -433,14 +500,14 @@ class ChordKeyGtk(object):
             _logger.info("Loading color scheme from " + color_scheme_filename)
 
 
-        color_scheme = ColorScheme.load(color_scheme_filename) \
-                       if color_scheme_filename else None
-        #layout = LayoutLoaderSVG().load(vk, layout_filename, color_scheme)
-
-
-        #self.keyboard.layout = layout
+        color_scheme = None
+        if color_scheme_filename:
+            from ChordKey.Appearance import ColorScheme
+            color_scheme = ColorScheme.load(color_scheme_filename)
+        self.keyboard.load_layout(layout_filename)
         self.keyboard.color_scheme = color_scheme
         self.keyboard.on_layout_loaded()
+        self._update_ui()
 
         if self._window and self._window.icp:
             self._window.icp.queue_draw()
@@ -457,11 +524,14 @@ class ChordKeyGtk(object):
 
     def get_vk(self):
         if not self._vk:
+            if not self._virtkey:
+                import virtkey
+                self._virtkey = virtkey
             try:
                 # may fail if there is no X keyboard (LP: 526791)
-                self._vk = virtkey.virtkey()
+                self._vk = self._virtkey.virtkey()
 
-            except virtkey.error as e:
+            except self._virtkey.error as e:
                 t = time.time()
                 if t > self._vk_error_time + .2: # rate limit to once per 200ms
                     _logger.warning("vk: " + unicode_str(e))
@@ -491,7 +561,8 @@ class ChordKeyGtk(object):
         if self.keyboard:
             self.keyboard.cleanup()
 
-        self.status_icon.set_keyboard_window(None)
+        if self.status_icon:
+            self.status_icon.set_keyboard_window(None)
         self._window.cleanup()
         self._window.destroy()
         self._window = None
@@ -559,6 +630,33 @@ class ServiceOnboardKeyboard(dbus.service.Object):
     def Hide(self):
         self._keyboard.set_visible(False)
 
+    @dbus.service.method(dbus_interface=IFACE,
+                         in_signature='aa(iii)', out_signature='asaid')
+    def InvokeChords(self, chords):
+        """
+        Invoke a batch of chords, each an array of (side, column, row)
+        keys, in a single main loop dispatch. Returns the labels of the
+        invoked actions, "" where a chord had none, the indices of those
+        failed chords and the elapsed time [ms].
+        """
+        keyboard = self._keyboard.keyboard
+        return keyboard.invoke_chords(chords, self._keyboard)
+
+    @dbus.service.method(dbus_interface=IFACE,
+                         in_signature='s', out_signature='d')
+    def TypeText(self, text):
+        """ Type text in one batch, returns the elapsed time [ms]. """
+        return self._keyboard.keyboard.type_text(text)
+
+    @dbus.service.method(dbus_interface=IFACE, out_signature='a{sa{sd}}')
+    def GetLatencyStats(self):
+        """ Latency percentiles [ms] of each input pipeline stage """
+        return get_latency_tracer().get_stats()
+
+    @dbus.service.method(dbus_interface=IFACE)
+    def ResetLatencyStats(self):
+        get_latency_tracer().reset()
+
     @dbus.service.method(dbus_interface=dbus.PROPERTIES_IFACE,
                          in_signature='ss', out_signature='v')
     def Get(self, iface, prop):
@@ -7,7 +7,7 @@ import sys
 import time
 from math import sin, pi
 
-from gi.repository         import GLib, Gdk, Gtk, Pango, PangoCairo
+from gi.repository         import GLib, Gtk, PangoCairo
 import cairo
 
 from ChordKey.utils         import Rect, Timer, FadeTimer, roundrect_arc
@@ -22,6 +22,10 @@ from ChordKey.KeyboardWidget import KeyboardWidget
 from ChordKey.KeyCommon     import LOD
 from ChordKey               import KeyCommon
 from ChordKey.TouchHandles  import TouchHandles
+from ChordKey.RenderCache   import KeyFaceAtlas, TextLayoutCache, \
+                                   PaneBackbuffer, PaneImageCache
+from ChordKey.KeyGeometry   import KeyGeometry
+from ChordKey.HitTest       import HitKind
 #from ChordKey.AtspiAutoShow import AtspiAutoShow
 
 ### Logging ###
@@ -45,100 +49,344 @@ STATE_NORMAL = 0
 STATE_HOVER = 1
 STATE_ACTIVATED = 2
 
-PangoUnscale = 1.0 / Pango.SCALE
-print( PangoUnscale)
+# key fill colors by draw state
+KEY_FILLS = {
+    STATE_NORMAL    : (0.8, 0.8, 0.8, 0.6),
+    STATE_HOVER     : (0.8, 0.5, 0.0, 1.0),
+    STATE_ACTIVATED : (0.0, 0.6, 0.2, 0.8),
+}
+
+class DamageTracker:
+    """
+    Remembers label and draw state of every key as of the last queued
+    redraw and finds the keys whose appearance changed since.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Forget everything, the next update damages all keys. """
+        self._labels = None
+        self._states = None
+
+    def update(self, labels, states):
+        """
+        Takes the new label and draw state lists, indexed by key index.
+        Returns the indices of all keys that need to be redrawn.
+        """
+        old_labels = self._labels
+        old_states = self._states
+        self._labels = labels
+        self._states = states
+
+        if old_labels is None or \
+           len(old_labels) != len(labels):
+            return list(range(len(labels)))
+
+        return [i for i in range(len(labels)) \
+                if labels[i] != old_labels[i] or \
+                   states[i] != old_states[i]]
+
+
 class SubPane:
+    """
+    Grid of keys on one side of the keyboard. Key tuples, key rects
+    and the key face size are computed once in update_layout.
+    """
+    rect = None
+    key_width = 0
+    key_height = 0
+    cols = 0
+    rows = 0
+    face_size = (0, 0)
+
+    def __init__(self, side):
+        self.side = side
+        self.keys = []          # [col][row] (side, col, row) key tuples
+        self.key_rects = []     # [col][row] Rects, shared, don't modify
+
     def update_layout(self, rect, cols, rows):
         self.rect = rect
         self.key_width = float(rect.w)/cols
         self.key_height = float(rect.h)/rows
         self.cols, self.rows = cols, rows
+        self.face_size = (int(round(self.key_width)),
+                          int(round(self.key_height)))
+
+        side = self.side
+        self.keys = [[(side, c, r) for r in range(rows)] \
+                     for c in range(cols)]
+        self.key_rects = [[Rect(rect.x + self.key_width * c,
+                                rect.y + self.key_height * r,
+                                self.key_width, self.key_height) \
+                           for r in range(rows)] for c in range(cols)]
 
     def key_rect(self, col, row):
-        return Rect(self.rect.x+self.key_width*col, self.rect.y+self.key_height*row, self.key_width, self.key_height)
-
-    def find_key(self, x, y):
-        c = int((x-self.rect.x)/self.key_width)
-        c = max(0,min(self.cols-1,c))
-        r = int((y-self.rect.y)/self.key_height)
-        r = max(0,min(self.rows-1,r))
-        return c, r
-    
+        """ Rect of the key, shared, copy() it before modifying """
+        return self.key_rects[col][row]
+
+    def get_face_size(self):
+        """ Pixel size of pre-rendered key faces """
+        return self.face_size
+
 class ChordKeyboardWidget(KeyboardWidget):
+    mid_rect = None
+    _speculation_key = None
+    _speculation_id = None
+
     def __init__(self, keyboard):
         KeyboardWidget.__init__(self,keyboard)
-        self.panes = [SubPane() for i in range(2)]
+        self.panes = [SubPane(side) for side in range(2)]
         self.keyboard = keyboard
         self.active_pointers = set()
         self.waiting = []
-        self._pango_layout = Pango.Layout(context=Gdk.pango_context_get())
+        self._label_tables = None
+        self._label_overrides = None
+        self._damage = DamageTracker()
+        self._key_faces = KeyFaceAtlas(self.draw_key_face)
+        self._text_layouts = TextLayoutCache()
+        self.key_geometry = KeyGeometry()
+        self._backbuffers = [PaneBackbuffer(self._render_idle_key,
+                                            self.redraw_all) \
+                             for side in range(2)]
+        self._prefix_images = PaneImageCache(self._render_idle_key)
 
     def calculate_layout(self, rect):
         dim = self.keyboard.dimensions()
         r = rect
-        keywidth = config.keyboard.key_width
+        keywidth = self.render_settings.key_width
         left_kdb_len = dim.left_cols*keywidth
-        right_kdb_len = dim.left_cols*keywidth
+        right_kdb_len = dim.right_cols*keywidth
         lrect = Rect(0,r[1],left_kdb_len,r[3])
+        old_sizes = [p.get_face_size() for p in self.panes]
+        old_grids = [(p.cols, p.rows) for p in self.panes]
         self.panes[LEFT].update_layout(lrect, dim.left_cols, dim.rows)
         rpos = rect.w-right_kdb_len
         rrect = Rect(rpos,r[1],right_kdb_len,r[3])
         self.panes[RIGHT].update_layout(rrect, dim.right_cols, dim.rows)
         
         self.mid_rect = Rect(left_kdb_len,r[1],rpos-left_kdb_len,r[3])
+        self.key_geometry.set_keys(
+            [key for p in self.panes for column in p.keys for key in column],
+            [kr for p in self.panes for column in p.key_rects for kr in column])
+        self._damage.reset()
+        if old_sizes != [p.get_face_size() for p in self.panes]:
+            # The face atlas is keyed by size and stays, faces of the
+            # old size age out of it once the new ones are drawn.
+            for backbuffer in self._backbuffers:
+                backbuffer.invalidate()
+            self._prefix_images.clear()
+        # Backbuffers rebuild on the next draw, the old images are
+        # scaled meanwhile, unless they show a different key grid.
+        for p, grid, backbuffer in zip(self.panes, old_grids,
+                                       self._backbuffers):
+            if (p.cols, p.rows) != grid:
+                backbuffer.clear()
+                self._prefix_images.clear()
     
     def draw_keyboard(self, context, draw_rect):
-        for side,panes in enumerate(self.panes):
-            if draw_rect.intersects(panes.rect):
-                self.draw_pane(side,context,draw_rect)
-
-    def draw_pane(self, side, context, draw_rect):
-        p = self.panes[side]
-        r = draw_rect
-        xmin, ymin = p.find_key(r.x,r.y)
-        xmax, ymax = p.find_key(r.x+r.w,r.y+r.h)
-        for x in range(xmin,xmax+1):
-            for y in range(ymin,ymax+1):
-                self.draw_key(side,x,y,context)
-
-    def draw_key(self, side, c, r, context):
-        rect = self.panes[side].key_rect(c,r)
-        state = self.get_key_drawstate((side,c,r))
-        label = self.get_key_label((side,c,r))
+        self._key_faces.set_theme(self.render_settings.version)
+        prefixes, overrides = self.get_label_prefixes()
+        get_table = self.keyboard.get_label_table
+        tables = [get_table(prefix) for prefix in prefixes]
+        self._label_tables, self._label_overrides = tables, overrides
+        key_index = self.keyboard.chords.key_index
+        geometry = self.key_geometry
+        keys = geometry.keys
+        lod = self.get_lod()
+        indices = geometry.get_keys_in_rect(draw_rect)
+
+        for side, pane in enumerate(self.panes):
+            if not draw_rect.intersects(pane.rect):
+                continue
+
+            backbuffer = self._get_backbuffer(side, prefixes[side],
+                                              tables[side], lod)
+
+            # keys that look different from their backbuffer image
+            baked = backbuffer.labels
+            items = []
+            dynamic = []
+            for i in indices:
+                key = keys[i]
+                if key[0] != side:
+                    continue
+                label = tables[side][key_index[key]]
+                if overrides:
+                    label = overrides.get(key, label)
+                items.append((i, label))
+                if baked.get(key) != label or \
+                   self.get_key_drawstate(key) != STATE_NORMAL:
+                    dynamic.append((i, label))
+
+            if backbuffer.draw(context, pane.rect,
+                               [geometry.rects[i] for i, label in dynamic]):
+                items = dynamic
+            for i, label in items:
+                if lod == LOD.FULL:
+                    self.draw_key(i, label, context)
+                else:
+                    self.draw_key_flat(i, label, context, lod)
+
+    def _get_backbuffer(self, side, prefix, table, lod):
+        """
+        Pane image to draw on top of. That is the speculative image
+        of prefix if it is ready, else the backbuffer of idle keys.
+        Nothing is rendered while interacting, transient sizes would
+        only evict key faces.
+        """
+        pane = self.panes[side]
+        theme = self.render_settings.version
+        if prefix:
+            image = self._prefix_images.get(side, prefix)
+            if image is not None and \
+               image.is_current(pane.rect, theme, table):
+                return image
+            if lod == LOD.FULL:
+                self._prefix_images.prepare(side, prefix, pane.rect,
+                        theme, table,
+                        lambda: self._get_pane_items(side, table))
+
+        backbuffer = self._backbuffers[side]
+        if lod == LOD.FULL:
+            idle_table = self.keyboard.get_label_table(())
+            backbuffer.update(pane.rect, theme, idle_table,
+                              lambda: self._get_pane_items(side, idle_table))
+        return backbuffer
+
+    def _get_pane_items(self, side, table):
+        """ (geometry index, key, label) of the keys of a pane """
+        key_index = self.keyboard.chords.key_index
+        return [(i, key, table[key_index[key]]) \
+                for i, key in enumerate(self.key_geometry.keys) \
+                if key[0] == side]
+
+    def _speculate(self, key):
+        """
+        Pre-render the pane images a finger on key may show next:
+        the chord context of key on both sides, and that of its
+        neighbors on the other side, which sliding to them relabels.
+        Even setting this up waits for idle, touch handling comes first.
+        """
+        if key is None or self.get_lod() != LOD.FULL:
+            return
+        self._speculation_key = key
+        if self._speculation_id is None:
+            self._speculation_id = GLib.idle_add(self._on_speculate,
+                                                 priority = GLib.PRIORITY_LOW)
+
+    def _on_speculate(self):
+        self._speculation_id = None
+        key = self._speculation_key
+        self._speculation_key = None
+        if key is None or key[1] >= self.panes[key[0]].cols or \
+           key[2] >= self.panes[key[0]].rows:
+            return False
+
+        theme = self.render_settings.version
+        get_table = self.keyboard.get_label_table
+        side, c, r = key
+        pane = self.panes[side]
+        jobs = [(side, (key,)), (1 - side, (key,))]
+        for nc, nr in ((c - 1, r), (c + 1, r), (c, r - 1), (c, r + 1)):
+            if 0 <= nc < pane.cols and 0 <= nr < pane.rows:
+                jobs.append((1 - side, (pane.keys[nc][nr],)))
+
+        for s, prefix in jobs:
+            table = get_table(prefix)
+            self._prefix_images.prepare(s, prefix, self.panes[s].rect,
+                    theme, table,
+                    lambda s=s, table=table: self._get_pane_items(s, table))
+        return False
 
+    def _render_idle_key(self, context, index, label):
+        """ Render a key into a backbuffer """
+        self._blit_key_face(context, index, label, STATE_NORMAL)
+
+    def draw_key(self, index, label, context):
+        """ Draw the key at index into key_geometry """
+        state = self.get_key_drawstate(self.key_geometry.keys[index])
+        self._blit_key_face(context, index, label, state)
+
+    def _blit_key_face(self, context, index, label, state):
+        x, y, w, h = self.key_geometry.face_rects[index]
+        face = self._key_faces.get(label, state, w, h)
+        context.set_source_surface(face, x, y)
+        context.rectangle(x, y, w, h)
+        context.fill()
+
+    def draw_key_flat(self, index, label, context, lod):
+        """
+        Reduced detail while interacting: flat fill without rounded
+        corners, cached label layout at LOD.REDUCED, no label at all at
+        LOD.MINIMAL. Bypasses the face atlas, so transient key sizes
+        of live resizing don't crowd the real faces out of it.
+        """
+        geometry = self.key_geometry
+        state = self.get_key_drawstate(geometry.keys[index])
+        rect = geometry.rects[index]
+        context.rectangle(rect.x + 3, rect.y + 3, rect.w - 6, rect.h - 6)
+        context.set_source_rgba(*KEY_FILLS[state])
+        context.fill()
+        if lod > LOD.MINIMAL:
+            self.draw_text_center(context, label, rect, 17, [0,0,0,1])
+
+    def draw_key_face(self, context, rect, label, state):
+        """ Render the face of a key into rect, used by the face atlas """
         draw_rect = rect.deflate(3)
-        roundness = config.theme_settings.roundrect_radius 
+        roundness = self.render_settings.roundrect_radius
         if roundness:
             roundrect_curve(context, draw_rect, roundness)
         else:
             context.rectangle(*draw_rect)
-        if state == STATE_HOVER:
-            fill = [0.8,0.5,0.0,1.0]
-        elif state == STATE_ACTIVATED:
-            fill = [0.0,0.6,0.2,0.8]
-        else:
-            fill = [0.8,0.8,0.8,0.6]
-        context.set_source_rgba(*fill)
+        context.set_source_rgba(*KEY_FILLS[state])
         context.fill()
         self.draw_text_center(context, label,rect,17,[0,0,0,1])
 
 
     def draw_text_center(self, context, text, rect, size, rgba):
-        l = self._pango_layout
-        l.set_text(text, -1)
-        font_description = Pango.FontDescription(config.theme_settings.key_label_font)
-        font_description.set_size(int(size*Pango.SCALE))
-        l.set_font_description(font_description)
-        w, h = l.get_size()   # In Pango units
-        w, h = w*PangoUnscale,h*PangoUnscale # in pixels
+        l, w, h = self._text_layouts.get(text,
+                                         self.render_settings.key_label_font,
+                                         size)
         x = int(rect.x + (rect.w-w)/2.0)
         y = int(rect.y + (rect.h-h)/2.0)
-        #print(x,y)
         context.move_to(x, y)
         context.set_source_rgba(*rgba)
         PangoCairo.show_layout(context, l)
 
 
+    def on_render_settings_changed(self, changes):
+        """ Overload for KeyboardWidget """
+        if "key_label_font" in changes:
+            self.invalidate_label_extents()
+        if "key_width" in changes:
+            self.update_layout()
+        KeyboardWidget.on_render_settings_changed(self, changes)
+
+    def cleanup(self):
+        for backbuffer in self._backbuffers:
+            backbuffer.clear()
+        self._prefix_images.clear()
+        if self._speculation_id is not None:
+            GLib.source_remove(self._speculation_id)
+            self._speculation_id = None
+        KeyboardWidget.cleanup(self)
+
+    def invalidate_keys(self):
+        """ Drop pre-rendered key faces """
+        self._key_faces.clear()
+        for backbuffer in self._backbuffers:
+            backbuffer.invalidate()
+        self._prefix_images.clear()
+
+    def invalidate_label_extents(self):
+        """ Drop shaped label text, key faces depend on it too """
+        self._text_layouts.clear()
+        self.invalidate_keys()
+
+    def invalidate_shadows(self):
+        pass
+
     def redraw_key(self, key):
         if key is None:
             return
@@ -150,13 +398,50 @@ class ChordKeyboardWidget(KeyboardWidget):
         for p in self.panes:
             self.queue_draw_area(*p.rect)
 
-    def find_key(self, x, y):
-        for i,pane in enumerate(self.panes):
-            if pane.rect.is_point_within((x,y)):
-                c, r = pane.find_key(x, y)
-                return i,c,r
+    def queue_damage(self):
+        """
+        Queue redraws only for keys whose label, fill or hover state
+        changed since the last call. Rects of neighboring keys are
+        merged before queuing.
+        """
+        keys = self.keyboard.chords.keys
+        tables, overrides = self.get_label_tables()
+        labels = [tables[key[0]][i] for i, key in enumerate(keys)]
+        for key, label in overrides.items():
+            index = self.keyboard.chords.key_index.get(key)
+            if not index is None:
+                labels[index] = label
+        states = [self.get_key_drawstate(key) for key in keys]
+
+        damaged = [keys[index] for index in self._damage.update(labels, states)]
+        for rect in self.key_geometry.get_damage_rects(damaged):
+            self.queue_draw_area(*rect)
+
+    def get_key_center(self, key):
+        """ Canvas point at the center of key, None if it isn't shown """
+        side, c, r = key
+        pane = self.panes[side]
+        if c < pane.cols and r < pane.rows:
+            return pane.key_rect(c, r).get_center()
         return None
 
+    def add_key_hit_targets(self, hit_map):
+        """ Overload for KeyboardWidget """
+        hit_map.set_key_geometry(self.key_geometry)
+        if self.mid_rect:
+            hit_map.add(self.mid_rect, HitKind.MID, None)
+
+    def find_key(self, x, y, previous = None):
+        """
+        Key at canvas point x, y or None. The previously hovered key
+        wins within key_hit_hysteresis of its borders.
+        """
+        if previous is not None:
+            previous = (HitKind.KEY, previous)
+        hit = self.hit_map.hit_test((x, y), (HitKind.KEY,), previous,
+                                    self.render_settings.key_hit_hysteresis)
+        return hit[1] if hit else None
+
     
     def get_key_drawstate(self, key):
         for seq in self.active_pointers:
@@ -168,18 +453,10 @@ class ChordKeyboardWidget(KeyboardWidget):
 
 
     def get_key_label(self, key):
-        seq = list(self.waiting)
-        if not seq and self.active_pointers:
-            p = next(iter(self.active_pointers))
-            if p.hover_key is not None:
-                seq.append(p.hover_key)
-
-        if key not in seq:
-            seq.append(key)
-        seq = self.get_context_keyseq(key)
-        label = self.keyboard.get_action_label(seq)
+        tables, overrides = self.get_label_tables()
+        label = overrides.get(key)
         if label is None:
-            return ""
+            label = tables[key[0]][self.keyboard.chords.key_index[key]]
         return label
 
     def on_ptr_down(self, seq):
@@ -190,13 +467,11 @@ class ChordKeyboardWidget(KeyboardWidget):
                 break
         if seq in self.active_pointers:
             # when consumed as modifer -> don't trigger single key action ("dead")
-            seq.is_dead = False 
-            seq.hover_key = None
-            self.on_ptr_move(seq)
+            seq.is_dead = False
+            seq.hover_key = self.find_key(*seq.point)
             seq.start_key = seq.hover_key
-            if seq.hover_key is not None:
-                #self.redraw_all() #uneconomic but does it for now
-                pass#self.on_key_down(seq.hover_key)
+            self._speculate(seq.start_key)
+            self.queue_damage()
             return True
         return False
 
@@ -204,11 +479,11 @@ class ChordKeyboardWidget(KeyboardWidget):
         if not seq in self.active_pointers:
             return False
         old_hover = seq.hover_key
-        seq.hover_key = self.find_key(*seq.point)
+        seq.hover_key = self.find_key(*seq.point, previous = old_hover)
         if seq.hover_key != old_hover:
-            #self.redraw_key(old_hover)
-            #self.redraw_key(seq.hover_key)
-            self.redraw_all() #uneconomic but does it for now
+            if len(self.active_pointers) == 1:
+                self._speculate(seq.hover_key)
+            self.queue_damage()
         return True
 
     
@@ -217,7 +492,7 @@ class ChordKeyboardWidget(KeyboardWidget):
             return False
         self.active_pointers.remove(seq)
         if seq.is_dead:
-            self.redraw_all()
+            self.queue_damage()
             return True
         # FIXME doesn't preverve order for tri-touch (not currently used...)
         key_seq = list(self.waiting)+ [p.hover_key for p in self.active_pointers if p is not None]
@@ -237,46 +512,66 @@ class ChordKeyboardWidget(KeyboardWidget):
                 hold_seq.is_dead = True# used as modifier, don't trigger single touch
             # last touch outside keyboard: cancel action
             if seq.hover_key is not None:
-                print(key_seq)
                 self.keyboard.invoke_action(key_seq,self)
             #for key in key_seq:
             #    self.redraw_key(key)
                 
 
-        #self.redraw_key(seq.hover_key)
-        self.redraw_all()
+        self.queue_damage()
         return True
 
-    def get_context_keyseq(self, key):
+    def get_label_tables(self):
+        """
+        Label tables of the current touch state, one for each side,
+        and a dict of keys that show the label of the held chord.
+        The tables are owned by the keyboard, don't modify them.
+        """
+        prefixes, overrides = self.get_label_prefixes()
+        get_table = self.keyboard.get_label_table
+        return [get_table(prefix) for prefix in prefixes], overrides
+
+    def get_label_prefixes(self):
+        """
+        Chord prefixes whose labels each side shows in the current
+        touch state, and a dict of keys that show the label of the
+        held chord.
+        """
+        keyboard = self.keyboard
+        overrides = {}
         if self.waiting:
-            keyseq = list(self.waiting)
-            if key not in keyseq:
-                keyseq.append(key)
-            return keyseq
+            prefix = tuple(self.waiting)
+            return (prefix, prefix), overrides
 
-        base_key = key
         if len(self.active_pointers) == 1:
+            # Keys show the chords they would complete with the start
+            # key, except when the finger slid to another key on the
+            # same side. The other side then completes with that one.
             (p,) = self.active_pointers
             start = p.start_key
             hover = p.hover_key
-            base_key = start
-            if hover is not None:
-                if hover[0] == start[0] and key[0] != hover[0]:
-                    base_key = hover
+            if start is None:
+                return ((), ()), overrides
+            prefixes = [(start,)] * 2
+            if hover is not None and hover[0] == start[0]:
+                prefixes[1 - hover[0]] = (hover,)
+            return prefixes, overrides
+
         elif len(self.active_pointers) == 2:
             #TODO: make active_pointer ordered list and remove last moved if double
-            active = [p.hover_key for p in self.active_pointers if p is not None]
-            if key in active:
-                return active # FIXME: assumes order agnostic
-            base_key = active[0]
-            if len(active) == 2:
-                if active[1][0] != key[0] and active[0][0] == key[0]:
-                    base_key = active[1]
-
-        if key != base_key:
-            return [base_key,key]
-        else:
-            return [key]
+            active = [p.hover_key for p in self.active_pointers]
+            label = keyboard.get_action_label(active) or ""
+            for key in active:
+                if key is not None:
+                    overrides[key] = label # FIXME: assumes order agnostic
+            base = active[0]
+            if base is None:
+                return ((None,), (None,)), overrides
+            prefixes = [(base,)] * 2
+            if active[1] is not None and active[1][0] != base[0]:
+                prefixes[base[0]] = (active[1],)
+            return prefixes, overrides
+
+        return ((), ()), overrides
 
     def has_active_sequence(self):
         return len(self.active_pointers ) > 0
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+""" Declarative chord layouts and their compiled, cached chord tables """
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import hashlib
+import pickle
+import xml
+from xml.dom import minidom
+
+from ChordKey            import Exceptions
+from ChordKey.utils      import Version, unicode_str
+
+### Logging ###
+import logging
+_logger = logging.getLogger("ChordLayout")
+###############
+
+
+class ChordLayout:
+    """
+    Compiled chord layout, the dimensions of the key grid and a flat
+    chord table. Actions are stored as plain tuples, shared by index,
+    and only become Action objects when a keyboard activates the layout.
+
+    Action tuples:
+        ("char", char, mods, label)
+        ("keycode", key_code, label)
+        ("mod", mod, label)
+        ("hide", label)
+    """
+    left_cols = 5
+    right_cols = 5
+    rows = 2
+
+    def __init__(self):
+        self.actions = []    # action tuples
+        self.chords = []     # (key_seq, index into actions) tuples
+
+    def dimensions(self):
+        """ Object with left_cols, right_cols and rows of the key grid """
+        return self
+
+    def create_mapping(self, keyboard):
+        """ Chord mapping of Action objects created by keyboard """
+        actions = [self._create_action(keyboard, a) for a in self.actions]
+        return dict((key_seq, actions[index]) \
+                    for key_seq, index in self.chords)
+
+    @staticmethod
+    def _create_action(keyboard, a):
+        type = a[0]
+        if type == "char":
+            return keyboard.char_action(a[1], mods = a[2], label = a[3])
+        if type == "keycode":
+            return keyboard.keycode_action(a[1], a[2])
+        if type == "mod":
+            return keyboard.mod_action(a[1], a[2])
+        if type == "hide":
+            return keyboard.hide_action(a[1])
+        raise ValueError("unknown action type '{}'".format(type))
+
+    def to_table(self):
+        return (self.left_cols, self.right_cols, self.rows,
+                tuple(self.actions), tuple(self.chords))
+
+    @staticmethod
+    def from_table(table):
+        layout = ChordLayout()
+        (layout.left_cols,
+         layout.right_cols,
+         layout.rows,
+         actions, chords) = table
+        layout.actions = list(actions)
+        layout.chords = list(chords)
+        return layout
+
+
+class ChordLayoutLoader:
+    """
+    Loads .chordlayout files.
+
+    Compiled chord tables are cached on disk, keyed by the source file's
+    mtime, size and hash. Unchanged layouts load by unpickling a single
+    table, layouts loaded before are reused from memory, which makes
+    switching layouts at runtime cheap.
+    """
+
+    # format of the .chordlayout file
+    LAYOUT_FORMAT = Version(1, 0)
+
+    # bump whenever the compiled table changes
+    TABLE_VERSION = 1
+
+    SIDES = {"left" : 0, "right" : 1}
+
+    def __init__(self, cache_dir = None):
+        self.cache_dir = cache_dir
+        self._loaded = {}   # filename: (mtime, size, layout)
+
+    def load(self, filename):
+        """
+        Compiled layout of filename.
+        Raises LayoutFileError if it can't be read or compiled.
+        """
+        filename = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError as ex:
+            raise Exceptions.LayoutFileError(
+                "failed to read layout '{}'".format(filename), ex)
+        stamp = (st.st_mtime, st.st_size)
+
+        loaded = self._loaded.get(filename)
+        if loaded and loaded[:2] == stamp:
+            return loaded[2]
+
+        layout = self._load_compiled(filename, stamp)
+        self._loaded[filename] = stamp + (layout,)
+        return layout
+
+    def _load_compiled(self, filename, stamp):
+        cache_filename = self._get_cache_filename(filename)
+        header, table = self._read_cache(cache_filename)
+
+        if header and header["source"] == filename and \
+           header["stamp"] == stamp:
+            return ChordLayout.from_table(table)
+
+        with open(filename, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+
+        # Touched, but unchanged? Keep the table, refresh the stamp.
+        if header and header["source"] == filename and \
+           header["hash"] == digest:
+            layout = ChordLayout.from_table(table)
+        else:
+            _logger.info("compiling chord layout '{}'".format(filename))
+            layout = self.compile(data, filename)
+
+        header = {"version" : self.TABLE_VERSION,
+                  "source" : filename,
+                  "stamp" : stamp,
+                  "hash" : digest}
+        self._write_cache(cache_filename, header, layout.to_table())
+        return layout
+
+    def _get_cache_filename(self, filename):
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha1(filename.encode("UTF-8")).hexdigest()[:12]
+        basename = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.cache_dir,
+                            "{}-{}.chordtable".format(basename, key))
+
+    def _read_cache(self, cache_filename):
+        """ (header, table) of a cached chord table, (None, None) if unusable """
+        if not cache_filename or \
+           not os.path.exists(cache_filename):
+            return None, None
+        try:
+            with open(cache_filename, "rb") as f:
+                header = pickle.load(f)
+                if header.get("version") != self.TABLE_VERSION:
+                    return None, None
+                table = pickle.load(f)
+        except Exception as ex:   # truncated, old python, ...
+            _logger.warning("ignoring chord table cache '{}': {}" \
+                            .format(cache_filename, unicode_str(ex)))
+            return None, None
+        return header, table
+
+    def _write_cache(self, cache_filename, header, table):
+        if not cache_filename:
+            return
+        tmp_filename = cache_filename + ".tmp"
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(tmp_filename, "wb") as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(table, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, cache_filename)
+        except (IOError, OSError) as ex:
+            _logger.warning("failed to write chord table cache '{}': {}" \
+                            .format(cache_filename, unicode_str(ex)))
+
+    def compile(self, data, filename = ""):
+        """ Compile the contents of a .chordlayout file """
+        try:
+            dom = minidom.parseString(data).documentElement
+        except xml.parsers.expat.ExpatError as ex:
+            raise Exceptions.LayoutFileError(
+                "failed to parse layout '{}'".format(filename), ex)
+
+        format = Version(1, 0)
+        if dom.hasAttribute("format"):
+            format = Version.from_string(dom.attributes["format"].value)
+        if format > self.LAYOUT_FORMAT:
+            _logger.warning("layout format {} of '{}' is newer than "
+                            "the supported format {}" \
+                            .format(format, filename, self.LAYOUT_FORMAT))
+
+        try:
+            return self._compile_dom(dom)
+        except (KeyError, ValueError) as ex:
+            raise Exceptions.LayoutFileError(
+                "invalid layout '{}'".format(filename), ex)
+
+    def _compile_dom(self, dom):
+        from ChordKey.Keyboard import Mods
+
+        layout = ChordLayout()
+        for attr in ("left_cols", "right_cols", "rows"):
+            if dom.hasAttribute(attr):
+                setattr(layout, attr, int(dom.attributes[attr].value))
+
+        action_indices = {}   # action tuple: index, shares equal actions
+        named_actions = {}    # id: index
+        chords = {}           # key_seq: index, later chords win
+
+        def add_action(action):
+            index = action_indices.get(action)
+            if index is None:
+                index = len(layout.actions)
+                layout.actions.append(action)
+                action_indices[action] = index
+            return index
+
+        def get_mods(node):
+            if not node.hasAttribute("mods"):
+                return ()
+            return tuple(getattr(Mods, name.upper()) \
+                         for name in node.attributes["mods"].value.split())
+
+        def get_side(node):
+            return self.SIDES[node.attributes["side"].value]
+
+        def get_key(value):
+            col, row = [int(v) for v in value.split(",")]
+            return col, row
+
+        def get_side_keys(side):
+            """ keys of one side row by row """
+            cols = (layout.left_cols, layout.right_cols)[side]
+            return [(side, col, row) for row in range(layout.rows) \
+                                     for col in range(cols)]
+
+        for node in dom.childNodes:
+            if node.nodeType != minidom.Node.ELEMENT_NODE:
+                continue
+            tag = node.tagName
+            attrs = node.attributes
+
+            if tag == "char":
+                action = ("char", attrs["char"].value, get_mods(node),
+                          node.getAttribute("label") or attrs["char"].value)
+                named_actions[attrs["id"].value] = add_action(action)
+
+            elif tag == "keycode":
+                action = ("keycode", int(attrs["code"].value),
+                          attrs["label"].value)
+                named_actions[attrs["id"].value] = add_action(action)
+
+            elif tag == "modifier":
+                action = ("mod", getattr(Mods, attrs["mod"].value.upper()),
+                          attrs["label"].value)
+                named_actions[attrs["id"].value] = add_action(action)
+
+            elif tag == "hide":
+                action = ("hide", attrs["label"].value)
+                named_actions[attrs["id"].value] = add_action(action)
+
+            elif tag == "singles":
+                side = get_side(node)
+                text = "".join(child.data for child in node.childNodes \
+                               if child.nodeType == minidom.Node.TEXT_NODE)
+                lines = [line.split() for line in text.splitlines()]
+                lines = [ids for ids in lines if ids]
+                for row, ids in enumerate(lines):
+                    for col, id in enumerate(ids):
+                        if id != "-":
+                            chords[((side, col, row),)] = named_actions[id]
+
+            elif tag == "pairs":
+                lcol, lrow = get_key(attrs["left"].value)
+                left_key = (0, lcol, lrow)
+                mods = get_mods(node)
+                for key, char in zip(get_side_keys(1),
+                                     attrs["chars"].value):
+                    if char != " ":
+                        index = add_action(("char", char, mods, char))
+                        chords[(left_key, key)] = index
+                        chords[(key, left_key)] = index
+
+            elif tag == "modified":
+                side = get_side(node)
+                column = int(attrs["column"].value)
+                mods = get_mods(node)
+                prefix = node.getAttribute("label")
+                for key, char in zip(get_side_keys(side),
+                                     attrs["chars"].value):
+                    if char != " ":
+                        row = key[2]
+                        other = (side, column, layout.rows - 1 - row)
+                        index = add_action(("char", char, mods,
+                                            prefix + char.upper()))
+                        chords[(key, other)] = index
+
+            else:
+                _logger.warning("unknown layout element '{}'".format(tag))
+
+        layout.chords = sorted(chords.items())
+        return layout
+
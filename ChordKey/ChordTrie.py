@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+""" Compiled chord lookup """
+
+from __future__ import division, print_function, unicode_literals
+
+### Logging ###
+import logging
+_logger = logging.getLogger("ChordTrie")
+###############
+
+
+class ChordNode:
+    """
+    State after a partial chord.
+    All members are flat lists indexed by key index: the node reached
+    by adding a key, the action completed by adding it and its label.
+    """
+    __slots__ = ("children", "actions", "labels")
+
+    def __init__(self, num_keys):
+        self.children = [None] * num_keys
+        self.actions  = [None] * num_keys
+        self.labels   = [None] * num_keys
+
+
+class ChordTrie:
+    """
+    Prefix trie of all chords of a key mapping, compiled at load time.
+
+    Keys are (side, col, row) tuples. They are translated to flat key
+    indices once, so every step of a lookup is a single list index.
+    """
+
+    def __init__(self, mapping, dimensions):
+        self.keys = self._collect_keys(mapping, dimensions)
+        self.key_index = dict((key, i) for i, key in enumerate(self.keys))
+        self.num_keys = len(self.keys)
+        self.root = ChordNode(self.num_keys)
+        self._no_completions = (None,) * self.num_keys
+
+        for key_seq, action in mapping.items():
+            self.insert(key_seq, action)
+
+    @staticmethod
+    def _collect_keys(mapping, dimensions):
+        """
+        All keys of the grid in (side, col, row) order, followed by
+        any key the mapping uses outside of the grid.
+        """
+        keys = []
+        for side, cols in enumerate((dimensions.left_cols,
+                                     dimensions.right_cols)):
+            for col in range(cols):
+                for row in range(dimensions.rows):
+                    keys.append((side, col, row))
+
+        known = set(keys)
+        for key_seq in mapping:
+            for key in key_seq:
+                if not key in known:
+                    _logger.warning("chord key {} outside of the key grid" \
+                                    .format(key))
+                    keys.append(key)
+                    known.add(key)
+        return keys
+
+    def insert(self, key_seq, action):
+        """ Add a chord, creating intermediate nodes as needed. """
+        node = self.root
+        last = len(key_seq) - 1
+        for i, key in enumerate(key_seq):
+            index = self.key_index[key]
+            if i == last:
+                node.actions[index] = action
+                node.labels[index] = action.label
+            else:
+                child = node.children[index]
+                if child is None:
+                    child = ChordNode(self.num_keys)
+                    node.children[index] = child
+                node = child
+
+    def find_node(self, prefix):
+        """ Node reached after the partial chord prefix, None if there is none. """
+        node = self.root
+        key_index = self.key_index
+        for key in prefix:
+            index = key_index.get(key)
+            if index is None:
+                return None
+            node = node.children[index]
+            if node is None:
+                return None
+        return node
+
+    def lookup(self, key_seq):
+        """ Action of the complete chord key_seq or None. """
+        if not key_seq:
+            return None
+        index = self.key_index.get(key_seq[-1])
+        if index is None:
+            return None
+        node = self.find_node(key_seq[:-1])
+        if node is None:
+            return None
+        return node.actions[index]
+
+    def get_completions(self, prefix):
+        """
+        Actions of all chords completing prefix by one more key,
+        indexed by key index. Entries are None where there is no chord.
+        """
+        node = self.find_node(prefix)
+        if node is None:
+            return self._no_completions
+        return node.actions
+
+    def get_labels(self, prefix):
+        """ Like get_completions, but returns the action labels. """
+        node = self.find_node(prefix)
+        if node is None:
+            return self._no_completions
+        return node.labels
+
+    def get_label(self, key, prefix = ()):
+        """ Label of key given the active partial chord prefix. """
+        index = self.key_index.get(key)
+        if index is None:
+            return None
+        return self.get_labels(prefix)[index]
+
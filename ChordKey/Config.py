@@ -17,6 +17,7 @@ from ChordKey.WindowUtils  import Handle, DockingEdge
 from ChordKey.ConfigUtils  import ConfigObject
 from ChordKey.MouseControl import Mousetweaks, ClickMapper
 from ChordKey.Exceptions   import SchemaError
+from ChordKey.RenderSettings import RenderSettings
 
 ### Logging ###
 import logging
@@ -86,7 +87,7 @@ class ConfigObj:
     _kbd_render_mixin_cls = GTK_KBD_MIXIN_CLS
 
     # extension of layout files
-    LAYOUT_FILE_EXTENSION = ".onboard"
+    LAYOUT_FILE_EXTENSION = ".chordlayout"
 
     # A copy of snippets so that when the list changes in gsettings we can
     # tell which items have changed.
@@ -132,6 +133,9 @@ class ConfigObj:
     # itself anymore for auto-show. (Precise)
     allow_iconifying = False
 
+    # snapshot of the settings drawing and input depend on
+    _render_settings = None
+
     def __init__(self):
         """
         Singleton constructor, runs only once.
@@ -162,6 +166,9 @@ class ConfigObj:
         parser.add_option("-q", "--quirks", dest="quirks",
                 help=_("Override auto-detection and manually select quirks\n"
                        "QUIRKS={metacity|compiz|mutter}"))
+        parser.add_option("--profile-startup", action="store_true",
+                dest="profile_startup",
+                help="Print a timeline of the startup phases")
         parser.add_option("--not-show-in", dest="not_show_in",
                 metavar="DESKTOPS",
                 help=_("Silently fail to start in the given desktop "
@@ -172,6 +179,8 @@ class ConfigObj:
         options = parser.parse_args()[0]
         self.options = options
 
+        self._render_settings_callbacks = []
+
         self.xid_mode = options.xid_mode
         self.quirks = options.quirks
 
@@ -211,10 +220,7 @@ class ConfigObj:
 
         # call base class constructor once logging is available
 
-        # init paths
-        self.install_dir = self._get_install_dir()
-        self.user_dir = self._get_user_dir()
-
+        self.init_paths()
 
         # Load system defaults (if there are any, not required).
         # Used for distribution specific settings, aka branding.
@@ -257,6 +263,11 @@ class ConfigObj:
 
         _logger.debug("Leaving init")
 
+    def init_paths(self):
+        """ Find the installation and user directories. """
+        self.install_dir = self._get_install_dir()
+        self.user_dir = self._get_user_dir()
+
     def cleanup(self):
         # This used to stop dangling main windows from responding
         # when restarting. Restarts don't happen anymore, keep
@@ -284,10 +295,45 @@ class ConfigObj:
                 for c in obj.children:
                     req_init_defaults(c)
         req_init_defaults(self)
+        self.update_render_settings()
+
+    def get_render_settings(self):
+        """ Current RenderSettings snapshot """
+        if self._render_settings is None:
+            self.update_render_settings()
+        return self._render_settings
+
+    def update_render_settings(self):
+        """
+        Take a new RenderSettings snapshot if any of its values changed
+        and tell the listeners. Call this after changing those settings.
+        """
+        values = RenderSettings.read_values(self)
+        old = self._render_settings
+        if old is not None and old.get_values() == values:
+            return False
+
+        version = old.version + 1 if old else 1
+        self._render_settings = RenderSettings(version, values)
+        _logger.debug("render settings changed: {}" \
+                      .format(self._render_settings.get_changes(old)))
+        for callback in list(self._render_settings_callbacks):
+            callback(self._render_settings)
+        return True
+
+    def render_settings_notify_add(self, callback):
+        """ callback(settings) is called with each new snapshot """
+        self._render_settings_callbacks.append(callback)
+
+    def render_settings_notify_remove(self, callback):
+        try:
+            self._render_settings_callbacks.remove(callback)
+        except ValueError:
+            pass
 
 
     def init_defaults(self):
-        self.layout = DEFAULT_LAYOUT
+        self.layout = self.options.layout or DEFAULT_LAYOUT
         self.theme = DEFAULT_THEME
         self.show_status_icon = True
         self.show_tooltips = True
@@ -359,8 +405,7 @@ class ConfigObj:
         self.layout_notify_add(callback)
 
     def get_layout_filename(self):
-        gskey = self.layout_key
-        return self.find_layout_filename(gskey.value, gskey.key,
+        return self.find_layout_filename(self.layout, "layout",
                                      self.LAYOUT_FILE_EXTENSION,
                                      os.path.join(self.install_dir,
                                                   "layouts", DEFAULT_LAYOUT +
@@ -625,6 +670,10 @@ class ConfigObj:
             src_icon_path = os.path.join(src_path, "icons")
             icon_theme.append_search_path(src_icon_path)
             result = src_path
+        # when run from a source tree without data directory
+        elif os.path.isfile(os.path.join(src_path, "layouts", DEFAULT_LAYOUT +
+                                         self.LAYOUT_FILE_EXTENSION)):
+            result = src_path
         # when installed to /usr/local
         elif os.path.isdir(LOCAL_INSTALL_DIR):
             result = LOCAL_INSTALL_DIR
@@ -681,6 +730,7 @@ class ConfigKeyboard:
         self.long_press_delay = 0.5
         self.touch_input =  2# MultiTouch
         self.key_width = 60
+        self.key_hit_hysteresis = 4 # [px] a hovered key extends this far
 
 
 class ConfigWindow:
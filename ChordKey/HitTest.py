@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+""" Spatial index of everything a pointer can hit """
+
+from __future__ import division, print_function, unicode_literals
+
+from math import floor
+
+### Logging ###
+import logging
+_logger = logging.getLogger("HitTest")
+###############
+
+
+class HitKind:
+    """ enum of hit target kinds, in order of precedence """
+    (
+        KEY,            # target is a (side, col, row) key
+        TOUCH_HANDLE,   # target is a Handle id
+        FRAME,          # target is a Handle id of the resize frame
+        MID,            # area between the key panes
+    ) = range(4)
+
+
+class HitTarget:
+    __slots__ = ("rect", "kind", "target", "test")
+
+    def __init__(self, rect, kind, target, test):
+        self.rect   = rect
+        self.kind   = kind
+        self.target = target
+        self.test   = test    # optional precise test, test(point) -> bool
+
+    def contains(self, point):
+        return self.rect.is_point_within(point) and \
+               (self.test is None or self.test(point))
+
+
+class HitTestMap:
+    """
+    Maps canvas points to hit targets with a single lookup.
+
+    Targets are rectangles, sorted into a coarse grid of buckets when
+    the layout changes. Points outside the grid use the nearest bucket,
+    so targets may reach beyond the canvas, e.g. the resize frame.
+    Keys are delegated to the layout's KeyGeometry, which tests all key
+    rects at once.
+    """
+    BUCKET_SIZE = 32
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._targets = []
+        self._buckets = []
+        self._key_geometry = None
+        self._cols = 0
+        self._rows = 0
+
+    def add(self, rect, kind, target, test = None):
+        """ Add a target, call build() when done. """
+        self._targets.append(HitTarget(rect, kind, target, test))
+
+    def set_key_geometry(self, key_geometry):
+        """ KeyGeometry that resolves HitKind.KEY """
+        self._key_geometry = key_geometry
+
+    def build(self, width, height):
+        """ Sort all targets into buckets covering width x height. """
+        size = self.BUCKET_SIZE
+        cols = max(1, int(width // size) + 1)
+        rows = max(1, int(height // size) + 1)
+        buckets = [[] for i in range(cols * rows)]
+
+        # stable sort, earlier targets win within each kind
+        targets = sorted(self._targets, key = lambda t: t.kind)
+        for t in targets:
+            x0, y0, x1, y1 = t.rect.to_extents()
+            c0 = self._clamp(int(floor(x0 / size)), cols)
+            c1 = self._clamp(int(floor(x1 / size)), cols)
+            r0 = self._clamp(int(floor(y0 / size)), rows)
+            r1 = self._clamp(int(floor(y1 / size)), rows)
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    buckets[r * cols + c].append(t)
+
+        self._buckets = buckets
+        self._cols = cols
+        self._rows = rows
+
+    def hit_test(self, point, kinds = None, previous = None, hysteresis = 0):
+        """
+        Returns (kind, target) of the first target containing point,
+        None if there is none. kinds optionally limits the search.
+
+        previous is the (kind, target) hit last time. A previous key is
+        kept while point stays within hysteresis pixels of it, which
+        stops flickering between neighboring keys.
+        """
+        geometry = self._key_geometry
+        if geometry is not None and \
+           (kinds is None or HitKind.KEY in kinds):
+            if previous is not None and previous[0] == HitKind.KEY:
+                previous_key = previous[1]
+            else:
+                previous_key = None
+            key = geometry.hit_test(point, previous_key, hysteresis)
+            if key is not None:
+                return HitKind.KEY, key
+
+        if not self._buckets:
+            return None
+        size = self.BUCKET_SIZE
+        c = self._clamp(int(floor(point[0] / size)), self._cols)
+        r = self._clamp(int(floor(point[1] / size)), self._rows)
+        for t in self._buckets[r * self._cols + c]:
+            if (kinds is None or t.kind in kinds) and \
+               t.contains(point):
+                return t.kind, t.target
+        return None
+
+    @staticmethod
+    def _clamp(index, n):
+        return 0 if index < 0 else n - 1 if index >= n else index
+
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+""" Key geometry of a layout as structure-of-arrays buffers """
+
+from __future__ import division, print_function, unicode_literals
+
+from ChordKey.utils import merge_adjacent_rects, Rect
+
+### Logging ###
+import logging
+_logger = logging.getLogger("KeyGeometry")
+###############
+
+try:
+    import numpy
+except ImportError as e:
+    numpy = None
+    _logger.info("numpy unavailable, key geometry falls back "
+                 "to python loops: {}".format(e))
+
+
+class KeyGeometry:
+    """
+    Position and size of every key shown, in arrays x, y, w, h, side,
+    col and row, indexed like keys. Clip culling, hit tests and damage
+    merging are vectorized over them, so they don't depend on a uniform
+    key grid and stay cheap for layouts with many keys.
+
+    Without numpy the same queries run as python loops over the rects.
+    """
+
+    # tolerance for rects to count as touching
+    EPSILON = 1e-3
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.keys = []          # (side, col, row) key tuples
+        self.rects = []         # Rects of keys, shared, don't modify
+        self.face_rects = []    # (x, y, w, h) pixel rects of key faces
+        self.index = {}         # key: index into the arrays
+        self.x = self.y = self.w = self.h = None
+        self.x1 = self.y1 = None
+        self.side = self.col = self.row = None
+
+    def set_keys(self, keys, rects):
+        """ Rebuild the arrays, rects are Rects of keys in the same order """
+        self.clear()
+        self.keys = list(keys)
+        self.rects = list(rects)
+        self.index = dict((key, i) for i, key in enumerate(self.keys))
+        self.face_rects = [(round(r.x), round(r.y),
+                            int(round(r.w)), int(round(r.h))) \
+                           for r in self.rects]
+        if numpy and self.keys:
+            coords = numpy.array([tuple(r) for r in self.rects],
+                                 dtype = numpy.float64)
+            self.x, self.y, self.w, self.h = \
+                [numpy.ascontiguousarray(a) for a in coords.T]
+            self.x1 = self.x + self.w
+            self.y1 = self.y + self.h
+            ids = numpy.array(self.keys, dtype = numpy.int32)
+            self.side, self.col, self.row = \
+                [numpy.ascontiguousarray(a) for a in ids.T]
+
+    def get_keys_in_rect(self, rect):
+        """ Indices of the keys intersecting rect """
+        if not self.keys:
+            return []
+        x0, y0, x1, y1 = rect.to_extents()
+        if numpy:
+            mask = (self.x < x1) & (self.x1 > x0) & \
+                   (self.y < y1) & (self.y1 > y0)
+            return numpy.flatnonzero(mask).tolist()
+        return [i for i, r in enumerate(self.rects) if r.intersects(rect)]
+
+    def hit_test(self, point, previous = None, hysteresis = 0):
+        """
+        Key at point, None if there is none. The previous key is kept
+        while point stays within hysteresis pixels of it.
+        """
+        if previous is not None and hysteresis:
+            i = self.index.get(previous)
+            if i is not None and \
+               self.rects[i].is_point_within(point, hysteresis):
+                return previous
+
+        if not self.keys:
+            return None
+        px = point[0]
+        py = point[1]
+        if numpy:
+            mask = (self.x <= px) & (self.x1 > px) & \
+                   (self.y <= py) & (self.y1 > py)
+            i = int(mask.argmax())
+            return self.keys[i] if mask[i] else None
+        for i, r in enumerate(self.rects):
+            if r.is_point_within(point):
+                return self.keys[i]
+        return None
+
+    def get_damage_rects(self, keys):
+        """
+        Rects covering keys, neighbors merged. Runs of keys in the same
+        row are joined first, the few remaining rects are merged with
+        merge_adjacent_rects().
+        """
+        index = self.index
+        indices = [index[key] for key in keys if key in index]
+        if len(indices) < 2 or not numpy:
+            return merge_adjacent_rects(self.rects[i] for i in indices)
+
+        eps = self.EPSILON
+        idx = numpy.array(indices)
+        x = self.x[idx]
+        y = self.y[idx]
+        w = self.w[idx]
+        h = self.h[idx]
+
+        # sort by row, then left to right
+        order = numpy.lexsort((x, h, y))
+        x = x[order]
+        y = y[order]
+        w = w[order]
+        h = h[order]
+
+        # a run continues while keys share y and h and touch horizontally
+        starts_run = numpy.ones(len(idx), dtype = bool)
+        starts_run[1:] = (numpy.abs(y[1:] - y[:-1]) >= eps) | \
+                         (numpy.abs(h[1:] - h[:-1]) >= eps) | \
+                         (numpy.abs(x[:-1] + w[:-1] - x[1:]) >= eps)
+        starts = numpy.flatnonzero(starts_run)
+        ends = numpy.append(starts[1:], len(idx)) - 1
+
+        x0 = x[starts].tolist()
+        x1 = (x[ends] + w[ends]).tolist()
+        y0 = y[starts].tolist()
+        hs = h[starts].tolist()
+        rects = [Rect(x0[i], y0[i], x1[i] - x0[i], hs[i]) \
+                 for i in range(len(x0))]
+        return merge_adjacent_rects(rects, eps)
+
@@ -5,13 +5,14 @@ from __future__ import division, print_function, unicode_literals
 import sys
 import gc
 
-from gi.repository import GObject, Gtk, Gdk, Atspi
+from gi.repository import GObject, GLib, Gtk, Gdk
 
 #from ChordKey              import KeyCommon
 #from ChordKey.KeyCommon    import StickyBehavior
 from ChordKey.MouseControl import MouseController
 #from ChordKey.Scanner      import Scanner
 from ChordKey.utils        import Timer, Modifiers, parse_key_combination
+from ChordKey.LatencyTracer import get_latency_tracer, LatencyStage
 #from ChordKey.canonical_equivalents import *
 
 try:
@@ -22,6 +23,10 @@ except DeprecationWarning:
 ### Config Singleton ###
 from ChordKey.Config import get_config
 config = get_config()
+########################
+
+latency_tracer = get_latency_tracer()
+
 class KeySynthVirtkey:
     """ Synthesize key strokes with python-virtkey """
 
@@ -57,11 +62,29 @@ class KeySynthVirtkey:
     def release_keycode(self, keycode):
         self._vk.release_keycode(keycode)
 
-    def lock_mod(self, mod):
-        self._vk.lock_mod(mod)
+    def lock_mod(self, mod_mask):
+        self._vk.lock_mod(mod_mask)
+
+    def unlock_mod(self, mod_mask):
+        self._vk.unlock_mod(mod_mask)
 
-    def unlock_mod(self, mod):
-        self._vk.unlock_mod(mod)
+    def type_key(self, kind, code, mod_mask = 0):
+        """
+        Press and release a key, with the modifiers of mod_mask locked
+        meanwhile. kind is "unicode", "keysym" or "keycode".
+        """
+        if mod_mask:
+            self.lock_mod(mod_mask)
+        getattr(self, "press_" + kind)(code)
+        getattr(self, "release_" + kind)(code)
+        if mod_mask:
+            self.unlock_mod(mod_mask)
+
+    def type_string(self, text):
+        """ Press and release the characters of text, one by one. """
+        for ch in text:
+            self.press_unicode(ch)
+            self.release_unicode(ch)
 
     def press_key_string(self, keystr):
         """
@@ -96,20 +119,205 @@ class KeySynthVirtkey:
 
 
 class KeySynthAtspi(KeySynthVirtkey):
-    """ Synthesize key strokes with AT-SPI """
+    """
+    Synthesize key strokes with AT-SPI. Atspi is slow to load,
+    it is imported on creation, not with this module.
+    """
 
     def __init__(self, vk):
         super(KeySynthAtspi, self).__init__(vk)
+        from gi.repository import Atspi
+        self._atspi = Atspi
 
     def press_key_string(self, string):
         #print("press_key_string")
+        Atspi = self._atspi
         Atspi.generate_keyboard_event(0, string, Atspi.KeySynthType.STRING)
 
+    def type_string(self, text):
+        """ All of text in a single AT-SPI string event. """
+        self.press_key_string(text)
+
     def press_keycode(self, keycode):
         #print("press_keycode")
+        Atspi = self._atspi
         Atspi.generate_keyboard_event(keycode, "", Atspi.KeySynthType.PRESS)
 
     def release_keycode(self, keycode):
         #print("release_keycode")
+        Atspi = self._atspi
         Atspi.generate_keyboard_event(keycode, "", Atspi.KeySynthType.RELEASE)
 
+
+class KeySynthQueue:
+    """
+    Defers key synthesis to the next main loop iteration. Runs of
+    plain characters typed meanwhile are sent with a single
+    type_string call, everything else in the order it was queued.
+    """
+
+    def __init__(self, key_synth = None):
+        self._key_synth = key_synth
+        self._ops = []
+        self._locked_mods = 0   # mask of the modifiers locked when flushed
+        self._idle_id = None
+
+    def cleanup(self):
+        self.flush()
+        if self._key_synth:
+            self._key_synth.cleanup()
+
+    def get_target(self):
+        """ The key synth that actually sends key strokes """
+        return self._key_synth
+
+    def set_target(self, key_synth):
+        self.flush()
+        self._key_synth = key_synth
+
+    def type_unicode(self, char):
+        """
+        Press and release char. Runs of characters are coalesced
+        unless modifiers are locked, those might not apply to
+        string events.
+        """
+        ops = self._ops
+        if not self._locked_mods and ops and ops[-1][0] == "type_string":
+            ops[-1][1].append(char)
+            return
+        if self._locked_mods:
+            self._queue("press_unicode", char)
+            self._queue("release_unicode", char)
+        else:
+            self._queue("type_string", [char])
+
+    def press_unicode(self, char):
+        self._queue("press_unicode", char)
+
+    def release_unicode(self, char):
+        self._queue("release_unicode", char)
+
+    def press_keysym(self, keysym):
+        self._queue("press_keysym", keysym)
+
+    def release_keysym(self, keysym):
+        self._queue("release_keysym", keysym)
+
+    def press_keycode(self, keycode):
+        self._queue("press_keycode", keycode)
+
+    def release_keycode(self, keycode):
+        self._queue("release_keycode", keycode)
+
+    def type_key(self, kind, code, mod_mask = 0):
+        self._queue("type_key", (kind, code, mod_mask))
+
+    def lock_mod(self, mod_mask):
+        self._locked_mods |= mod_mask
+        self._queue("lock_mod", mod_mask)
+
+    def unlock_mod(self, mod_mask):
+        self._locked_mods &= ~mod_mask
+        self._queue("unlock_mod", mod_mask)
+
+    def forget_mods(self, mod_mask):
+        """
+        The modifiers of mod_mask were released elsewhere, e.g. by a
+        physical key. Stop treating them as locked, without unlocking.
+        """
+        self._locked_mods &= ~mod_mask
+
+    def press_key_string(self, keystr):
+        self._queue("press_key_string", keystr)
+
+    def _queue(self, name, arg):
+        self._ops.append((name, arg))
+        if self._idle_id is None:
+            self._idle_id = GLib.idle_add(self._on_idle,
+                                          priority = GLib.PRIORITY_HIGH_IDLE)
+
+    def _on_idle(self):
+        self._idle_id = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """ Send everything queued right away. """
+        if self._idle_id is not None:
+            GLib.source_remove(self._idle_id)
+            self._idle_id = None
+
+        ops = self._ops
+        if not ops:
+            return
+        self._ops = []
+
+        key_synth = self._key_synth
+        if key_synth:
+            for name, arg in ops:
+                if name == "type_string":
+                    key_synth.type_string("".join(arg))
+                elif name == "type_key":
+                    key_synth.type_key(*arg)
+                else:
+                    getattr(key_synth, name)(arg)
+            latency_tracer.mark(LatencyStage.SYNTH)
+
+
+class KeySynthRecorder:
+    """
+    Records key strokes instead of sending them,
+    for replaying input without an X server to type into.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def cleanup(self):
+        pass
+
+    def clear(self):
+        self.events = []
+
+    def get_text(self):
+        """ Characters typed with press_unicode and string functions """
+        text = []
+        for name, arg in self.events:
+            if name in ("press_unicode", "press_key_string", "type_string"):
+                text.append(arg)
+            elif name == "type_key" and arg[0] == "unicode":
+                text.append(arg[1])
+        return "".join(text)
+
+    def type_string(self, text):
+        self.events.append(("type_string", text))
+
+    def press_unicode(self, char):
+        self.events.append(("press_unicode", char))
+
+    def release_unicode(self, char):
+        self.events.append(("release_unicode", char))
+
+    def press_keysym(self, keysym):
+        self.events.append(("press_keysym", keysym))
+
+    def release_keysym(self, keysym):
+        self.events.append(("release_keysym", keysym))
+
+    def press_keycode(self, keycode):
+        self.events.append(("press_keycode", keycode))
+
+    def release_keycode(self, keycode):
+        self.events.append(("release_keycode", keycode))
+
+    def type_key(self, kind, code, mod_mask = 0):
+        self.events.append(("type_key", (kind, code, mod_mask)))
+
+    def lock_mod(self, mod_mask):
+        self.events.append(("lock_mod", mod_mask))
+
+    def unlock_mod(self, mod_mask):
+        self.events.append(("unlock_mod", mod_mask))
+
+    def press_key_string(self, keystr):
+        self.events.append(("press_key_string", keystr))
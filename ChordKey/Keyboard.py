@@ -2,16 +2,23 @@
 
 from __future__ import division, print_function, unicode_literals
 
+import os
 import sys
 import gc
+import time
 
-from gi.repository import GObject, Gtk, Gdk, Atspi
+from gi.repository import GObject, Gtk, Gdk
 
 from ChordKey              import KeyCommon
 from ChordKey.MouseControl import MouseController
-from ChordKey.utils        import Timer, Modifiers, parse_key_combination
+from ChordKey.utils        import Timer, Modifiers, parse_key_combination, \
+                                  unicode_str
 #from ChordKey.canonical_equivalents import *
-from ChordKey.KeySynth import KeySynthAtspi, KeySynthVirtkey
+from ChordKey.KeySynth import KeySynthAtspi, KeySynthVirtkey, KeySynthQueue
+from ChordKey.ChordTrie import ChordTrie
+from ChordKey.ChordLayout import ChordLayoutLoader
+from ChordKey.Exceptions import LayoutFileError
+from ChordKey.LatencyTracer import get_latency_tracer, LatencyStage
 
 try:
     from ChordKey.utils import run_script, get_keysym_from_name, dictproperty
@@ -27,6 +34,9 @@ config = get_config()
 import logging
 _logger = logging.getLogger("Keyboard")
 ###############
+
+latency_tracer = get_latency_tracer()
+
 # enum of event types for key press/release
 class EventType:
     (
@@ -44,21 +54,33 @@ class DockMode:
     ) = range(3)
 
 class Mods:
+    """ X modifier masks, combine them with | """
     SHIFT = 1
     CAPS = 2
     CTRL = 4
     ALT = 8
-    NUMLK = 15
+    NUMLK = 16
     MOD3 = 32
     SUPER = 64
     ALTGR = 128
 
+    @staticmethod
+    def to_mask(mods):
+        """ Combined mask of a sequence of modifiers """
+        mask = 0
+        for mod in mods:
+            mask |= mod
+        return mask
+
 MOD_LATCHED, MOD_LOCKED = range(2)
     
 # should be treated as "inner classes" of ChordKeyboard 
 class Action:
-    def __init__(self,label,invoke=None):
+    needs_view = False   # invoke() acts on the view, can't do without
+
+    def __init__(self,label,invoke=None,needs_view=False):
         self.label = label
+        self.needs_view = needs_view
         if invoke is not None:
             self.invoke = invoke
 
@@ -73,39 +95,31 @@ class TypeAction(Action):
         self.key_type = key_type
         self.code = key_code
         self.mods = mods
+        self.mod_mask = Mods.to_mask(mods)
 
-    def _send_key_press(self):
-        key_synth = self.keyboard._key_synth
-        ktype =  self.key_type
-        if ktype == KeyCommon.CHAR_TYPE:
-            key_synth.press_unicode(self.code)
-        elif ktype == KeyCommon.KEYSYM_TYPE:
-            key_synth.press_keysym(self.code)
-        elif ktype == KeyCommon.KEYPRESS_NAME_TYPE:
-            key_synth.press_keysym(get_keysym_from_name(self.code))
-        elif ktype == KeyCommon.KEYCODE_TYPE:
-            key_synth.press_keycode(self.code)
-
-    def _send_key_release(self):
-        key_synth = self.keyboard._key_synth
+    def _get_synth_key(self):
+        """ (kind, code) for the key synth's type_key() """
         ktype = self.key_type
         if ktype == KeyCommon.CHAR_TYPE:
-            key_synth.release_unicode(self.code)
+            return "unicode", self.code
         elif ktype == KeyCommon.KEYSYM_TYPE:
-            key_synth.release_keysym(self.code)
+            return "keysym", self.code
         elif ktype == KeyCommon.KEYPRESS_NAME_TYPE:
-            key_synth.release_keysym(get_keysym_from_name(self.code))
+            return "keysym", get_keysym_from_name(self.code)
         elif ktype == KeyCommon.KEYCODE_TYPE:
-            key_synth.release_keycode(self.code);
+            return "keycode", self.code
+        return None, None
 
     def invoke(self, view):
         key_synth = self.keyboard._key_synth
-        for mod in self.mods:
-            key_synth.lock_mod(mod)
-        self._send_key_press()
-        self._send_key_release()
-        for mod in self.mods:
-            key_synth.unlock_mod(mod)
+        if self.key_type == KeyCommon.CHAR_TYPE and not self.mod_mask:
+            key_synth.type_unicode(self.code)
+            return True
+        kind, code = self._get_synth_key()
+        if kind:
+            # modifiers the keyboard holds already stay untouched
+            mod_mask = self.mod_mask & ~self.keyboard.get_synth_mods()
+            key_synth.type_key(kind, code, mod_mask)
         return True
 
 # TODO: specify Sticky/latchy/lazyness
@@ -118,30 +132,46 @@ class ModAction(Action):
         self.mode = mode
 
     def invoke(self, view):
-        key_synth = self.keyboard._key_synth
-        mods = self.keyboard.mods
-        status = mods.get(self.mod,None)
-        if status is None:
-            key_synth.lock_mod(self.mod)
-            mods[self.mod] = MOD_LATCHED
-        elif status == MOD_LATCHED:
-            mods[self.mod] = MOD_LOCKED
-        elif status == MOD_LOCKED:
-            key_synth.unlock_mod(self.mod)
-            del mods[self.mod]
+        """ Cycle through latched, locked and released """
+        keyboard = self.keyboard
+        mod = self.mod
+        latched = keyboard.latched_mods
+        locked = keyboard.locked_mods
+        if latched & mod:
+            latched &= ~mod
+            locked |= mod
+        elif locked & mod:
+            locked &= ~mod
+        else:
+            latched |= mod
+        keyboard.set_mod_state(latched, locked)
         return False # don't consume mods
         
 
 class ChordKeyboard:
-    def __init__(self):
-        from ChordKey.testLayout import configure
-        self.mapping = configure(self)
-        self.configured = True
+    # key grid of each side
+    left_cols = 5
+    right_cols = 5
+    rows = 2
 
+    def __init__(self):
         self.waiting = []
-        self.mods = {}
-
-        self._key_synth = None
+        self._label_tables = {}
+
+        # modifier masks
+        self.latched_mods = 0     # released after the next key stroke
+        self.locked_mods = 0      # held until unlocked
+        self.keymap_mods = 0      # real modifier state of the X keymap
+        self._synth_mods = 0      # locked in the key synth by us
+        self._confirmed_mods = 0  # _synth_mods seen in the keymap state
+        self._layouts = {}   # filename: (ChordLayout, mapping, ChordTrie)
+        self._layout_loader = ChordLayoutLoader(
+                         os.path.join(config.user_dir, "cache"))
+        self.layout_filename = None
+        self.set_mapping({})
+        self.load_layout(config.layout_filename)
+
+        self._key_synth = KeySynthQueue()
         self._key_synth_virtkey = None
         self._key_synth_atspi = None
 
@@ -154,8 +184,7 @@ class ChordKeyboard:
 
 
     def dimensions(self):
-        self.left_cols = self.right_cols = 5
-        self.rows = 2
+        """ Object with left_cols, right_cols and rows of the key grid """
         return self
 
     def cleanup(self):
@@ -163,26 +192,142 @@ class ChordKeyboard:
 
     def init_key_synth(self, vk):
         self._key_synth_virtkey = KeySynthVirtkey(vk)
-        self._key_synth_atspi = KeySynthAtspi(vk)
+        self._key_synth_atspi = None
 
         if config.keyboard.key_synth: # == KeySynth.ATSPI:
-            self._key_synth = self._key_synth_atspi
+            # only load Atspi when it is actually used
+            self._key_synth_atspi = KeySynthAtspi(vk)
+            self.set_key_synth(self._key_synth_atspi)
         else: # if config.keyboard.key_synth == KeySynth.VIRTKEY:
-            self._key_synth = self._key_synth_virtkey
+            self.set_key_synth(self._key_synth_virtkey)
+
+    def set_key_synth(self, key_synth):
+        """ Key synth that receives the queued key strokes """
+        self._key_synth.set_target(key_synth)
+
+    def flush_key_synth(self):
+        """ Send queued key strokes now instead of when idle """
+        self._key_synth.flush()
 
 
     def on_layout_loaded(self):
         pass
 
-    def set_modifiers(self, *a):
-        pass
+    def get_mod_state(self, mod):
+        """ MOD_LATCHED, MOD_LOCKED or None """
+        if self.locked_mods & mod:
+            return MOD_LOCKED
+        if self.latched_mods & mod:
+            return MOD_LATCHED
+        return None
+
+    def get_synth_mods(self):
+        """ Modifier mask currently locked in the key synth by us """
+        return self._synth_mods
+
+    def set_mod_state(self, latched, locked):
+        """
+        Set the latched and locked modifier masks. The key synth
+        gets at most one combined lock and one unlock call.
+        """
+        if latched == self.latched_mods and \
+           locked == self.locked_mods:
+            return
+        self.latched_mods = latched
+        self.locked_mods = locked
+
+        mods = latched | locked
+        lock = mods & ~self._synth_mods
+        unlock = self._synth_mods & ~mods
+        if unlock:
+            self._key_synth.unlock_mod(unlock)
+        if lock:
+            self._key_synth.lock_mod(lock)
+        self._synth_mods = mods
+        self._confirmed_mods &= mods
+
+    def set_modifiers(self, mod_mask):
+        """
+        The modifier state of the X keymap changed, mod_mask is the new
+        state. Modifiers we locked that were seen in the keymap before
+        and are gone now, were released by someone else, e.g. a
+        physical key. Drop them, so the keyboard doesn't drift out of
+        sync. Modifiers not seen yet may still be queued in the synth.
+        Returns True if the keyboard's modifier state changed.
+        """
+        self.keymap_mods = mod_mask
+        self._confirmed_mods |= self._synth_mods & mod_mask
+        lost = self._confirmed_mods & ~mod_mask
+        if lost:
+            _logger.debug("modifiers 0x{:x} released externally" \
+                          .format(lost))
+            self._synth_mods &= ~lost
+            self._key_synth.forget_mods(lost)
+            self._confirmed_mods &= ~lost
+            self.latched_mods &= ~lost
+            self.locked_mods &= ~lost
+            return True
+        return False
+
+    def load_layout(self, filename):
+        """
+        Activate the chord layout of filename. Layouts loaded before
+        keep their actions and chord trie, switching back is cheap.
+        Returns False and keeps the current layout on failure.
+        """
+        try:
+            layout = self._layout_loader.load(filename)
+        except LayoutFileError as ex:
+            _logger.error(unicode_str(ex))
+            return False
+
+        cached = self._layouts.get(filename)
+        if cached and cached[0] is layout:
+            layout, mapping, chords = cached
+        else:
+            mapping = layout.create_mapping(self)
+            chords = ChordTrie(mapping, layout.dimensions())
+            self._layouts[filename] = (layout, mapping, chords)
+
+        self.left_cols = layout.left_cols
+        self.right_cols = layout.right_cols
+        self.rows = layout.rows
+        self.layout_filename = filename
+        self.set_mapping(mapping, chords)
+        return True
+
+    def set_mapping(self, mapping, chords = None):
+        """
+        Activate a new chord mapping, chords optionally is
+        its ChordTrie, compiled if not given.
+        """
+        self.mapping = mapping
+        if chords is None:
+            chords = ChordTrie(mapping, self.dimensions())
+        self.chords = chords
+        self.configured = True
+        self.invalidate_label_tables()
 
     def get_action(self, key_seq):
         if not self.configured:
             return None
-        return self.mapping.get(tuple(key_seq),None)
+        return self.chords.lookup(key_seq)
+
+    def get_completions(self, prefix):
+        """
+        Actions completing the partial chord prefix,
+        indexed by key index of self.chords.
+        """
+        return self.chords.get_completions(prefix)
+
+    def get_key_label(self, key, prefix = ()):
+        """ Label of key given the partial chord prefix """
+        if not self.configured:
+            return None
+        return self.chords.get_label(key, prefix)
 
     def invoke_action(self, key_seq,view=None):
+        latency_tracer.mark(LatencyStage.INVOKE)
         a = self.get_action(key_seq)
         if a is not None:
             status = a.invoke(view)
@@ -192,6 +337,77 @@ class ChordKeyboard:
         else:
             return False
 
+    def invoke_chords(self, key_seqs, view = None):
+        """
+        Invoke a batch of chords, each a sequence of (side, col, row)
+        keys, and send the resulting key strokes right away.
+        Returns the labels of the invoked actions, "" for chords without
+        action, the indices of those chords and the elapsed time [ms].
+        Without a view, chords of actions that need one fail too.
+        """
+        start = time.time()
+        labels = []
+        failed = []
+        for i, key_seq in enumerate(key_seqs):
+            key_seq = [tuple(key) for key in key_seq]
+            action = self.get_action(key_seq)
+            if action is not None and \
+               (view is not None or not action.needs_view) and \
+               self.invoke_action(key_seq, view):
+                labels.append(action.label)
+            else:
+                labels.append("")
+                failed.append(i)
+        self.flush_key_synth()
+        return labels, failed, (time.time() - start) * 1000.0
+
+    def type_text(self, text):
+        """
+        Type text as plain characters, ignoring the chord mapping.
+        Returns the elapsed time [ms].
+        """
+        start = time.time()
+        for char in text:
+            self._key_synth.type_unicode(char)
+        self.flush_key_synth()
+        return (time.time() - start) * 1000.0
+
+    def get_label_table(self, prefix = ()):
+        """
+        Labels of all keys while the partial chord prefix is held,
+        indexed by key index of self.chords. Keys that are part of
+        the prefix show the label of the prefix chord itself.
+        Tables are cached until the mapping changes.
+        """
+        prefix = tuple(prefix)
+        table = self._label_tables.get(prefix)
+        if table is None:
+            table = self._build_label_table(prefix)
+            self._label_tables[prefix] = table
+        return table
+
+    def _build_label_table(self, prefix):
+        chords = self.chords
+        table = [label or "" for label in chords.get_labels(prefix)]
+        if prefix:
+            own_label = self.get_action_label(prefix) or ""
+            for key in prefix:
+                index = chords.key_index.get(key)
+                if not index is None:
+                    table[index] = own_label
+        return table
+
+    def invalidate_label_tables(self):
+        """
+        Drop all label tables and precompute the ones for the
+        idle state and for every single held key.
+        """
+        self._label_tables = {}
+        if self.configured:
+            self.get_label_table(())
+            for key in self.chords.keys:
+                self.get_label_table((key,))
+
     def get_action_label(self, key_seq):
         a = self.get_action(key_seq)
         if a is not None:
@@ -213,13 +429,12 @@ class ChordKeyboard:
         return ModAction(self, label, mod, key_code, mode)
 
     def hide_action(self,label):
-        return Action(label, invoke=lambda v: v.set_visible(False))
+        return Action(label, invoke=lambda v: v.set_visible(False),
+                      needs_view=True)
 
     def unlatch_mods(self):
-        for mod,status in list(self.mods.items()):
-            if status == MOD_LATCHED:
-                del self.mods[mod]
-                self._key_synth.unlock_mod(mod)
+        if self.latched_mods:
+            self.set_mod_state(0, self.locked_mods)
 
 
     def conf_stupid(self):
@@ -230,7 +445,8 @@ class ChordKeyboard:
             c = c + 31
             self.mapping[(0,c1,r1),(1,c2,r2)] = self.char_action(chr(c))
             self.mapping[(1,c2,r2),(0,c1,r1)] = self.char_action(chr(c))
-        
+        self.set_mapping(self.mapping)
+
         #for  c1, r1, in product(range(5),range(2)):
         #    c = c1+10*(r1+2*(c2+10*r2))
         #    c = c + 31
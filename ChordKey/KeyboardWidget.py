@@ -5,7 +5,7 @@ from __future__ import division, print_function, unicode_literals
 
 import sys
 import time
-from math import sin, pi
+from math import sin, pi, hypot
 
 from gi.repository         import GLib, Gdk, Gtk
 
@@ -18,7 +18,9 @@ from ChordKey.Keyboard      import EventType
 from ChordKey.KeyCommon     import LOD
 from ChordKey               import KeyCommon
 from ChordKey.TouchHandles  import TouchHandles
-from ChordKey.AtspiAutoShow import AtspiAutoShow
+from ChordKey.HitTest       import HitTestMap, HitKind
+from ChordKey.LatencyTracer import get_latency_tracer, LatencyStage
+from ChordKey.StartupProfile import get_startup_profile
 
 ### Logging ###
 import logging
@@ -30,10 +32,8 @@ from ChordKey.Config import get_config
 config = get_config()
 ########################
 
-try:
-    from gi.repository import Atspi
-except ImportError as e:
-    _logger.info(_("Atspi unavailable, auto-hide won't be available"))
+latency_tracer = get_latency_tracer()
+startup_profile = get_startup_profile()
 
 # Gnome introspection calls are surprisingly expensive
 # -> prepare stuff for faster access
@@ -105,6 +105,11 @@ class InactivityTimer(Timer):
         self._keyboard.commit_transition()
         return False
 
+def get_monotonic_time():
+    """ Monotonic time in seconds, the time base of Gdk frame clocks """
+    return GLib.get_monotonic_time() / 1000000.0
+
+
 class TransitionVariable:
     """ A variable taking part in opacity transitions """
     value        = 0.0
@@ -118,18 +123,21 @@ class TransitionVariable:
         """ Begin transition """
         self.start_value = self.value
         self.target_value = target
-        self.start_time = time.time()
+        self.start_time = get_monotonic_time()
         self.duration = duration
         self.done = False
 
-    def update(self):
+    def update(self, now = None):
         """
         Update self.value based on the elapsed time since start_transition.
+        now is the monotonic time in seconds, e.g. the frame time.
         """
         range = self.target_value - self.start_value
         if range and self.duration:
-            elapsed  = time.time() - self.start_time
-            lin_progress = min(1.0, elapsed / self.duration)
+            if now is None:
+                now = get_monotonic_time()
+            elapsed  = now - self.start_time
+            lin_progress = max(0.0, min(1.0, elapsed / self.duration))
         else:
             lin_progress = 1.0
         sin_progress = (sin(lin_progress * pi - pi / 2.0) + 1.0) / 2.0
@@ -149,9 +157,9 @@ class TransitionState:
 
         self.target_visibility = False
 
-    def update(self):
+    def update(self, now = None):
         for var in self._vars:
-            var.update()
+            var.update(now)
 
     def is_done(self):
         return all(var.done for var in self._vars)
@@ -166,12 +174,20 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
     TRANSITION_DURATION_SLIDE = 0.25
     TRANSITION_DURATION_OPACITY_HIDE = 0.3
 
+    LOD_RESTORE_DELAY = 0.2     # [s] idle time until full detail returns
+    LOD_FAST_MOTION = 1500.0    # [px/s] multi-touch speed reducing detail
+
     def __init__(self, keyboard):
+        # hold on to the settings snapshot instead of reading config
+        self.render_settings = config.get_render_settings()
+        config.render_settings_notify_add(self._on_render_settings_changed)
+
         Gtk.DrawingArea.__init__(self)
         WindowManipulator.__init__(self)
         TouchInput.__init__(self)
 
         self.canvas_rect = Rect()
+        self.hit_map = HitTestMap()
 
         self._last_click_time = 0
         self._last_click_key = None
@@ -185,8 +201,7 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
 
 
         self.inactivity_timer = InactivityTimer(self)
-        self.auto_show = AtspiAutoShow(self)
-        self.auto_show.enable(config.is_auto_show_enabled())
+        self._auto_show = None
 
         self.touch_handles = TouchHandles()
         self.touch_handles_hide_timer = Timer()
@@ -196,6 +211,8 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
         self._aspect_ratio = None
 
         self._transition_timer = Timer()
+        self._transition_tick_id = None
+        self._transition_applied = None
         self._transition_state = TransitionState()
         self._transition_state.visible.value = 0.0
         self._transition_state.active.value = 1.0
@@ -204,6 +221,10 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
 
         self._configure_timer = Timer()
 
+        self._lod = LOD.FULL
+        self._lod_timer = Timer()
+        self._motion_samples = {}   # sequence id: (x, y, time) of last motion
+
 
         #self.set_double_buffered(False)
         self.set_app_paintable(True)
@@ -232,6 +253,7 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
             self.update_resize_handles()
 
     def cleanup(self):
+        config.render_settings_notify_remove(self._on_render_settings_changed)
 
         # Enter-notify isn't called when resizing without crossing into
         # the window again. Do it here on exit, at the latest, to make sure
@@ -241,13 +263,14 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
         # stop timer callbacks for unused, but not yet destructed keyboards
         self.touch_handles_fade.stop()
         self.touch_handles_hide_timer.stop()
-        self._transition_timer.stop()
+        self._stop_transition_clock()
         self.inactivity_timer.stop()
         self._long_press_timer.stop()
         self._auto_release_timer.stop()
         #self.auto_show.cleanup()
         self.stop_click_polling()
         self._configure_timer.stop()
+        self._lod_timer.stop()
 
         # free xserver memory
         self.invalidate_keys()
@@ -317,10 +340,24 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
                                 self.get_allocated_height())
         r = self.canvas_rect.deflate(self.get_frame_width())
         self.calculate_layout(r)
+        self.touch_handles.update_positions(self.canvas_rect)
+        self.update_hit_test_map()
 
         # update the aspect ratio of the main window
         self.on_layout_updated()
 
+    def _on_render_settings_changed(self, settings):
+        old = self.render_settings
+        self.render_settings = settings
+        self.on_render_settings_changed(settings.get_changes(old))
+
+    def on_render_settings_changed(self, changes):
+        """
+        New render settings, changes are the names of the changed fields.
+        Overload this to drop whatever depends on them.
+        """
+        self.queue_draw()
+
     def update_resize_handles(self):
         """ Tell WindowManipulator about the active resize handles """
         docking = config.is_docking_enabled()
@@ -333,6 +370,70 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
         self.touch_handles.set_active_handles(self._get_active_drag_handles(True))
         self.touch_handles.lock_x_axis(docking)
 
+        self.update_hit_test_map()
+
+    def update_hit_test_map(self):
+        """
+        Rebuild the hit-test index. Call this whenever keys, touch
+        handles or the resize frame change place.
+        """
+        hit_map = self.hit_map
+        hit_map.clear()
+        self.add_key_hit_targets(hit_map)
+
+        touch_handles = self.touch_handles
+        for handle in touch_handles.handles:
+            if not handle.get_rect() is None:
+                hit_map.add(handle.get_hit_rect().inflate(1.0),
+                            HitKind.TOUCH_HANDLE, handle.id,
+                            lambda point, handle = handle: \
+                                touch_handles.active and \
+                                handle.hit_test(point))
+
+        self._add_frame_hit_targets(hit_map)
+        hit_map.build(self.get_allocated_width(),
+                      self.get_allocated_height())
+
+    def add_key_hit_targets(self, hit_map):
+        """ Overload to make keys hit-testable """
+        pass
+
+    def _add_frame_hit_targets(self, hit_map):
+        """
+        Resize frame, corners before edges. The frame continues outside
+        of the canvas, as the pointer may leave it while dragging.
+        """
+        canvas_rect = self.get_resize_frame_rect()
+        handles = self.get_drag_handles()
+        hit_frame_width = self.get_hit_frame_width()
+        w = min(canvas_rect.w / 2, hit_frame_width)
+        h = min(canvas_rect.h / 2, hit_frame_width)
+        m = max(canvas_rect.w, canvas_rect.h)
+        x0, y0, x1, y1 = canvas_rect.to_extents()
+
+        corners = {Handle.NORTH_WEST : (x0 - m, y0 - m, x0 + w, y0 + h),
+                   Handle.NORTH_EAST : (x1 - w, y0 - m, x1 + m, y0 + h),
+                   Handle.SOUTH_EAST : (x1 - w, y1 - h, x1 + m, y1 + m),
+                   Handle.SOUTH_WEST : (x0 - m, y1 - h, x0 + w, y1 + m)}
+        edges   = {Handle.WEST  : (x0 - m, y0 - m, x0 + w, y1 + m),
+                   Handle.EAST  : (x1 - w, y0 - m, x1 + m, y1 + m),
+                   Handle.NORTH : (x0 - m, y0 - m, x1 + m, y0 + h),
+                   Handle.SOUTH : (x0 - m, y1 - h, x1 + m, y1 + m)}
+        for areas in (corners, edges):
+            for handle in handles:
+                extents = areas.get(handle)
+                if extents:
+                    hit_map.add(Rect.from_extents(*extents),
+                                HitKind.FRAME, handle)
+
+    def _get_auto_show(self):
+        """ AtspiAutoShow, created on first use, Atspi is slow to load """
+        if self._auto_show is None:
+            from ChordKey.AtspiAutoShow import AtspiAutoShow
+            self._auto_show = AtspiAutoShow(self)
+        return self._auto_show
+    auto_show = property(_get_auto_show)
+
     def update_auto_show(self):
         """
         Turn on/off auto-show in response to user action (preferences)
@@ -490,15 +591,52 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
         if config.xid_mode:
             return
 
+        self._transition_applied = None  # window may have changed since
         duration = self._transition_state.get_max_duration()
         if duration == 0.0:
+            self._stop_transition_clock()
             self._on_transition_step()
         else:
-            self._transition_timer.start(0.02, self._on_transition_step)
+            self._start_transition_clock()
+
+    def _start_transition_clock(self):
+        """
+        Step transitions with the frame clock, in sync with vsync.
+        Unmapped windows have no ticking frame clock, they are stepped
+        by timer until the window is shown.
+        """
+        if self.get_mapped():
+            self._transition_timer.stop()
+            if self._transition_tick_id is None:
+                self._transition_tick_id = \
+                        self.add_tick_callback(self._on_transition_tick, None)
+        elif self._transition_tick_id is None:
+            self._transition_timer.start(0.02, self._on_transition_timer)
+
+    def _stop_transition_clock(self):
+        self._transition_timer.stop()
+        if self._transition_tick_id is not None:
+            self.remove_tick_callback(self._transition_tick_id)
+            self._transition_tick_id = None
+
+    def _on_transition_tick(self, widget, frame_clock, user_data):
+        now = frame_clock.get_frame_time() / 1000000.0
+        if self._on_transition_step(now):
+            return True
+        self._transition_tick_id = None
+        return False
+
+    def _on_transition_timer(self):
+        if not self._on_transition_step():
+            return False
+        if self.get_mapped():
+            self._start_transition_clock()  # hand over to the frame clock
+            return False
+        return True
 
-    def _on_transition_step(self):
+    def _on_transition_step(self, now = None):
         state = self._transition_state
-        state.update()
+        state.update(now)
 
         done              = state.is_done()
 
@@ -512,18 +650,28 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
 
         window = self.get_kbd_window()
         if window:
-            if window.get_opacity() != opacity:
-                window.set_opacity(opacity)
-
             visible_before = window.is_visible()
             visible_later  = state.target_visibility
 
-            # move
+            if visible_before and not done:
+                self.reduce_lod()
+
+            # Skip frames that wouldn't change anything on screen,
+            # opacity has 8 bit resolution at most.
+            opacity = round(opacity * 255.0) / 255.0
             x = int(state.x.value)
             y = int(state.y.value)
-            wx, wy = window.get_position()
-            if x != wx or y != wy:
-                window.reposition(x, y)
+            applied = (opacity, x, y)
+            if self._transition_applied != applied:
+                self._transition_applied = applied
+
+                if window.get_opacity() != opacity:
+                    window.set_opacity(opacity)
+
+                # move
+                wx, wy = window.get_position()
+                if x != wx or y != wy:
+                    window.reposition(x, y)
 
             # show/hide
             visible = (visible_before or visible_later) and not done or \
@@ -630,8 +778,8 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
             window.on_user_positioning_begin()
 
     def on_drag_activated(self):
-        if self.is_resizing():
-            self._lod = LOD.MINIMAL
+        """ Overload for WindowManipulator """
+        self.reduce_lod(LOD.MINIMAL if self.is_resizing() else LOD.REDUCED)
 
     def on_drag_done(self):
         """ Overload for WindowManipulator """
@@ -639,7 +787,47 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
         if window:
             window.on_user_positioning_done()
 
-        #self.reset_lod() FIXME
+    def get_lod(self):
+        """ Level of detail to draw with """
+        return self._lod
+
+    def reduce_lod(self, lod = LOD.REDUCED):
+        """
+        Draw with at most lod until drags, transitions and fast
+        motion have been idle for LOD_RESTORE_DELAY, then repaint
+        once at full detail.
+        """
+        if lod < self._lod:
+            self._lod = lod
+        self._lod_timer.start(self.LOD_RESTORE_DELAY, self._on_lod_timer)
+
+    def _on_lod_timer(self):
+        if self.is_drag_active() or \
+           self._transition_tick_id is not None or \
+           self._transition_timer.is_running():
+            return True  # still busy, check again later
+        self.reset_lod()
+        return False
+
+    def reset_lod(self):
+        """ Back to full level of detail """
+        self._lod_timer.stop()
+        if self._lod != LOD.FULL:
+            self._lod = LOD.FULL
+            self.redraw_all()
+
+    def _update_motion_lod(self, sequence):
+        """ Reduce detail while several fingers move fast """
+        samples = self._motion_samples
+        x, y = sequence.point
+        t = sequence.updated
+        last = samples.get(sequence.id)
+        samples[sequence.id] = (x, y, t)
+        if last and len(self._input_sequences) > 1:
+            dt = t - last[2]
+            if dt > 0 and \
+               hypot(x - last[0], y - last[1]) > self.LOD_FAST_MOTION * dt:
+                self.reduce_lod(LOD.REDUCED)
 
 
 
@@ -668,16 +856,21 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
 
     def hit_test_move_resize(self, point):
         """ Overload for WindowManipulator """
-        hit = self.touch_handles.hit_test(point)
-        if hit is None:
-            hit = WindowManipulator.hit_test_move_resize(self, point)
-        return hit
+        hit = self.hit_map.hit_test(point, (HitKind.TOUCH_HANDLE,
+                                            HitKind.FRAME))
+        return hit[1] if hit else None
+
+    def hit_test_touch_handles(self, point):
+        """ Id of the active touch handle at point or None """
+        hit = self.hit_map.hit_test(point, (HitKind.TOUCH_HANDLE,))
+        return hit[1] if hit else None
 
     def _on_configure_event(self, widget, user_data):
         if self.canvas_rect.w != self.get_allocated_width() or \
            self.canvas_rect.h != self.get_allocated_height():
+            if self.is_drag_active():
+                self.reduce_lod(LOD.MINIMAL)
             self.update_layout()
-            self.touch_handles.update_positions(self.canvas_rect)
             #self.invalidate_keys()
             #if self._lod == LOD.FULL:
             #    self.invalidate_shadows()
@@ -765,7 +958,7 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
         # hit-test touch handles 
         hit_handle = None
         if not hit_key and self.touch_handles.active:
-            hit_handle = self.touch_handles.hit_test(point)
+            hit_handle = self.hit_test_touch_handles(point)
             self.touch_handles.set_pressed(hit_handle)
             if not hit_handle is None:
                 # handle clicked -> stop auto-show until button release
@@ -805,7 +998,7 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
                 self.key_down(sequence)
 
                 # start long press detection
-                delay = config.keyboard.long_press_delay
+                delay = self.render_settings.long_press_delay
                 if key.id == "move":  # don't show touch handels too easily
                     delay += 0.3
                 self._long_press_timer.start(delay,
@@ -828,9 +1021,11 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
 
             # hit-test touch handles first
             if self.touch_handles.active:
-                hit_handle = self.touch_handles.hit_test(point)
+                hit_handle = self.hit_test_touch_handles(point)
                 self.touch_handles.set_prelight(hit_handle)
 
+        self._update_motion_lod(sequence)
+
         # hit-test keys
         if hit_handle is None:
             hit_key = self.on_ptr_move(sequence)
@@ -857,6 +1052,7 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
     def on_input_sequence_end(self, sequence):
         """ Button release/touch end """
         hit_key = self.on_ptr_up(sequence)
+        self._motion_samples.pop(sequence.id, None)
 
         self.stop_drag()
         self.stop_long_press()
@@ -950,6 +1146,7 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
             size, size_mm = self.get_monitor_dimensions()
             self.touch_handles.set_monitor_dimensions(size, size_mm)
             self.touch_handles.update_positions(self.canvas_rect)
+            self.update_hit_test_map()
 
             if auto_hide:
                 self.start_touch_handles_auto_hide()
@@ -1014,6 +1211,8 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
             corner_radius = config.CORNER_RADIUS if decorated else 0
             self.touch_handles.set_corner_radius(corner_radius)
             self.touch_handles.draw(context)
+        latency_tracer.mark(LatencyStage.DRAW)
+        startup_profile.mark("first frame")
 
     def emit_quit_onboard(self, data=None):
         _logger.debug("Entered emit_quit_onboard")
@@ -1162,7 +1361,7 @@ class KeyboardWidget(Gtk.DrawingArea, WindowManipulator, TouchInput):
                 .format(Gtk.Settings.get_default().get_property("gtk-xft-dpi")))
 
         self.invalidate_label_extents()
-        self.keyboard.update_ui()
+        self.queue_draw()
 
     def edit_snippet(self, snippet_id):
         dialog = Gtk.Dialog(_("New snippet"),
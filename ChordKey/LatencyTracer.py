@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+""" Input-to-keystroke latency measurement """
+
+from __future__ import division, print_function, unicode_literals
+
+from collections import deque
+
+from ChordKey.utils import monotonic
+
+### Logging ###
+import logging
+_logger = logging.getLogger("LatencyTracer")
+###############
+
+
+class LatencyStage:
+    """ enum of pipeline stages, in pipeline order """
+    (
+        EVENT,          # X/Gdk event time until python received it
+        RECEIVE,        # python received the touch end
+        SEQUENCE_END,   # on_input_sequence_end
+        INVOKE,         # ChordKeyboard.invoke_action
+        SYNTH,          # key press/release synthesized
+        DRAW,           # next frame drawn
+    ) = range(6)
+
+    names = ("event", "receive", "sequence_end", "invoke", "synth", "draw")
+
+
+class LatencyTracer:
+    """
+    Timestamps the stages a touch release passes through until the
+    keystroke is sent and the keyboard redrawn. Latencies of all stages
+    are relative to the time the event was received, except the EVENT
+    stage. X event times use the server clock, so that one is measured
+    against the smallest offset between both clocks seen so far, i.e. it
+    is the delay beyond the fastest delivery observed.
+    """
+    MAX_SAMPLES = 1024
+    TRACE_TIMEOUT = 1.0     # [s] forget traces that never got drawn
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Drop all samples """
+        self._samples = [deque(maxlen = self.MAX_SAMPLES) \
+                         for name in LatencyStage.names]
+        self._clock_offset = None
+        self._trace_start = None
+        self._trace_marked = None
+
+    def begin(self, event_time):
+        """
+        A touch release was received with X event time event_time [ms].
+        Starts a new trace unless one is in flight already.
+        """
+        now = monotonic()
+        if self._trace_start is not None and \
+           now - self._trace_start < self.TRACE_TIMEOUT:
+            return
+
+        offset = now * 1000.0 - event_time
+        if self._clock_offset is None or \
+           offset < self._clock_offset:
+            self._clock_offset = offset
+        self._samples[LatencyStage.EVENT].append(offset - self._clock_offset)
+        self._samples[LatencyStage.RECEIVE].append(0.0)
+
+        self._trace_start = now
+        self._trace_marked = set()
+
+    def mark(self, stage):
+        """
+        The trace in flight reached stage. Frames drawn before the
+        release was handled, e.g. motion redraws, don't end the trace.
+        """
+        if self._trace_start is None or \
+           stage in self._trace_marked:
+            return
+        if stage == LatencyStage.DRAW and \
+           LatencyStage.SEQUENCE_END not in self._trace_marked and \
+           LatencyStage.INVOKE not in self._trace_marked:
+            return
+        self._trace_marked.add(stage)
+        elapsed = (monotonic() - self._trace_start) * 1000.0
+        self._samples[stage].append(elapsed)
+
+        if stage == LatencyStage.DRAW:
+            self._trace_start = None
+
+    def get_stats(self):
+        """
+        Percentiles for each stage in ms,
+        {stage name : {"count", "p50", "p95", "p99"}}.
+        """
+        stats = {}
+        for name, samples in zip(LatencyStage.names, self._samples):
+            values = sorted(samples)
+            stats[name] = {"count" : float(len(values)),
+                           "p50" : self._percentile(values, 0.50),
+                           "p95" : self._percentile(values, 0.95),
+                           "p99" : self._percentile(values, 0.99)}
+        return stats
+
+    @staticmethod
+    def _percentile(values, fraction):
+        if not values:
+            return 0.0
+        index = min(len(values) - 1, int(len(values) * fraction))
+        return float(values[index])
+
+
+_tracer = None
+
+def get_latency_tracer():
+    global _tracer
+    if _tracer is None:
+        _tracer = LatencyTracer()
+    return _tracer
+
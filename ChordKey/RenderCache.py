@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+""" Caches for pre-rendered keyboard graphics """
+
+from __future__ import division, print_function, unicode_literals
+
+from collections import OrderedDict
+from math import floor, ceil
+
+from gi.repository import GLib, Gdk, Pango
+import cairo
+
+from ChordKey.utils import Rect
+
+### Logging ###
+import logging
+_logger = logging.getLogger("RenderCache")
+###############
+
+
+class KeyFaceAtlas:
+    """
+    LRU cache of pre-rendered key faces.
+    There is one ImageSurface per (label, state, key size, theme),
+    painting a key becomes a single blit.
+    """
+    MAX_FACES = 256
+
+    def __init__(self, render_func, max_faces = None):
+        """
+        render_func(context, rect, label, state) draws a key face
+        into rect of the given cairo context.
+        """
+        self._render_func = render_func
+        self._max_faces = max_faces or self.MAX_FACES
+        self._faces = OrderedDict()
+        self._theme = None
+
+    def clear(self):
+        """ Drop all faces, e.g. when key dimensions changed. """
+        self._faces.clear()
+
+    def set_theme(self, theme):
+        """
+        theme is any comparable value describing the look of key faces.
+        All faces are dropped when it changes.
+        """
+        if self._theme != theme:
+            self._theme = theme
+            self.clear()
+
+    def get(self, label, state, w, h):
+        """ Surface with the key face, rendered on first use. """
+        key = (label, state, w, h)
+        faces = self._faces
+        surface = faces.pop(key, None)
+        if surface is None:
+            surface = self._render(label, state, w, h)
+            if len(faces) >= self._max_faces:
+                faces.popitem(last = False)   # least recently used
+        faces[key] = surface
+        return surface
+
+    def _render(self, label, state, w, h):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        context = cairo.Context(surface)
+        self._render_func(context, Rect(0, 0, w, h), label, state)
+        return surface
+
+
+class TextLayoutCache:
+    """
+    Shaped label text. Keeps a prebuilt Pango.Layout and its pixel
+    extents per (text, font, size), label sets are small and repeat.
+    """
+    MAX_LAYOUTS = 512
+
+    def __init__(self):
+        self._layouts = {}
+        self._font_descriptions = {}
+        self._pango_context = None
+
+    def clear(self):
+        """
+        Drop all layouts, e.g. when the font dpi changed.
+        Layouts created afterwards use a fresh pango context.
+        """
+        self._layouts = {}
+        self._font_descriptions = {}
+        self._pango_context = None
+
+    def get(self, text, font, size):
+        """ Returns (layout, width, height), extents in pixels. """
+        key = (text, font, size)
+        entry = self._layouts.get(key)
+        if entry is None:
+            if len(self._layouts) >= self.MAX_LAYOUTS:
+                self._layouts = {}
+            entry = self._create(text, font, size)
+            self._layouts[key] = entry
+        return entry
+
+    def _create(self, text, font, size):
+        if self._pango_context is None:
+            self._pango_context = Gdk.pango_context_get()
+        layout = Pango.Layout(context=self._pango_context)
+        layout.set_text(text, -1)
+        layout.set_font_description(self._get_font_description(font, size))
+        w, h = layout.get_size()   # In Pango units
+        return layout, w / Pango.SCALE, h / Pango.SCALE
+
+    def _get_font_description(self, font, size):
+        key = (font, size)
+        font_description = self._font_descriptions.get(key)
+        if font_description is None:
+            font_description = Pango.FontDescription(font)
+            font_description.set_size(int(size * Pango.SCALE))
+            self._font_descriptions[key] = font_description
+        return font_description
+
+
+class PaneBackbuffer:
+    """
+    Retained image of the static look of a key pane, all keys idle
+    with their idle labels. Draws blit it and only paint the keys over
+    it whose label or state differ.
+
+    Rebuilds run a few keys per idle callback, so resizing never blocks
+    input. Until a rebuild completes the previous image is drawn, scaled
+    to the new pane size.
+    """
+    KEYS_PER_STEP = 8
+
+    _build = None     # [surface, image rect, todo items, source, labels]
+    _idle_id = None
+
+    def __init__(self, render_key, on_ready = None,
+                 priority = GLib.PRIORITY_DEFAULT_IDLE):
+        """
+        render_key(context, index, label) paints the idle key with
+        geometry index in canvas coordinates. on_ready() is called
+        when a rebuild completed.
+        """
+        self._render_key = render_key
+        self._on_ready = on_ready
+        self._priority = priority
+        self.clear()
+
+    def clear(self):
+        """ Drop the image and stop rebuilding """
+        self._stop_build()
+        self._surface = None
+        self._image_rect = None  # canvas rect of the surface, integers
+        self._source = None      # (pane rect, theme, label table) shown
+        self.labels = {}         # key: label in the image
+
+    def invalidate(self):
+        """
+        The look of keys changed, rebuild on the next update. The
+        outdated image is still drawn until then.
+        """
+        self._stop_build()
+        self._source = None
+
+    def is_empty(self):
+        return self._surface is None
+
+    def is_current(self, pane_rect, theme, label_table):
+        """ Is the finished image up to date? """
+        return self._is_source(self._source,
+                               (tuple(pane_rect), theme, label_table))
+
+    def update(self, pane_rect, theme, label_table, get_items):
+        """
+        Make sure the image is, or is being, rebuilt for pane_rect,
+        theme and the idle label_table. get_items() returns
+        (geometry index, key, label) of all keys of the pane.
+        """
+        source = (tuple(pane_rect), theme, label_table)
+        if self._is_source(self._source, source) or \
+           self._build and self._is_source(self._build[3], source):
+            return
+        self._start_build(pane_rect, source, get_items())
+
+    def draw(self, context, pane_rect, holes = ()):
+        """
+        Blit the image into pane_rect, except for the rects in holes
+        where keys are drawn on top. Returns False without an image.
+        """
+        if self._surface is None:
+            return False
+        ir = self._image_rect
+        x0 = floor(pane_rect.x)
+        y0 = floor(pane_rect.y)
+        w = ceil(pane_rect.x + pane_rect.w) - x0
+        h = ceil(pane_rect.y + pane_rect.h) - y0
+
+        context.save()
+        context.set_antialias(cairo.ANTIALIAS_NONE)
+        context.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+        context.rectangle(x0, y0, w, h)
+        for rect in holes:
+            context.rectangle(*rect)
+        context.clip()
+        if (x0, y0, w, h) == tuple(ir):
+            context.set_source_surface(self._surface, ir.x, ir.y)
+        else:
+            # stale image of another size, scale it meanwhile
+            context.translate(x0, y0)
+            context.scale(w / ir.w, h / ir.h)
+            context.set_source_surface(self._surface, 0, 0)
+        context.paint()
+        context.restore()
+        return True
+
+    @staticmethod
+    def _is_source(a, b):
+        return a is not None and \
+               a[0] == b[0] and a[1] == b[1] and a[2] is b[2]
+
+    def _start_build(self, pane_rect, source, items):
+        self._stop_build()
+        x0 = int(floor(pane_rect.x))
+        y0 = int(floor(pane_rect.y))
+        w = max(1, int(ceil(pane_rect.x + pane_rect.w)) - x0)
+        h = max(1, int(ceil(pane_rect.y + pane_rect.h)) - y0)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self._build = [surface, Rect(x0, y0, w, h), list(items), source, {}]
+        self._idle_id = GLib.idle_add(self._on_build_step,
+                                      priority = self._priority)
+
+    def _stop_build(self):
+        if self._idle_id is not None:
+            GLib.source_remove(self._idle_id)
+        self._idle_id = None
+        self._build = None
+
+    def _on_build_step(self):
+        surface, image_rect, todo, source, labels = self._build
+        context = cairo.Context(surface)
+        context.translate(-image_rect.x, -image_rect.y)
+        for index, key, label in todo[:self.KEYS_PER_STEP]:
+            self._render_key(context, index, label)
+            labels[key] = label
+        del todo[:self.KEYS_PER_STEP]
+        if todo:
+            return True
+
+        self._idle_id = None
+        self._build = None
+        self._surface = surface
+        self._image_rect = image_rect
+        self._source = source
+        self.labels = labels
+        if self._on_ready:
+            self._on_ready()
+        return False
+
+
+class PaneImageCache:
+    """
+    Bounded LRU of pane images for chord prefixes, pre-rendered
+    speculatively at low idle priority. Once the finger moves the
+    relabelled pane is a single blit.
+    """
+    MAX_IMAGES = 16
+
+    def __init__(self, render_key, max_images = None):
+        self._render_key = render_key
+        self._max_images = max_images or self.MAX_IMAGES
+        self._images = OrderedDict()   # (side, prefix): PaneBackbuffer
+
+    def clear(self):
+        for image in self._images.values():
+            image.clear()
+        self._images.clear()
+
+    def get(self, side, prefix):
+        """ PaneBackbuffer of the prefix, None if there is none """
+        key = (side, prefix)
+        image = self._images.pop(key, None)
+        if image is not None:
+            self._images[key] = image   # most recently used
+        return image
+
+    def prepare(self, side, prefix, pane_rect, theme, label_table, get_items):
+        """ Start rendering the pane image of prefix unless it exists. """
+        image = self.get(side, prefix)
+        if image is None:
+            if len(self._images) >= self._max_images:
+                key, old = self._images.popitem(last = False)
+                old.clear()
+            image = PaneBackbuffer(self._render_key,
+                                   priority = GLib.PRIORITY_LOW)
+            self._images[(side, prefix)] = image
+        image.update(pane_rect, theme, label_table, get_items)
+        return image
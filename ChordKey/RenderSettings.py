@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+""" Versioned snapshot of the settings drawing and input depend on """
+
+from __future__ import division, print_function, unicode_literals
+
+### Logging ###
+import logging
+_logger = logging.getLogger("RenderSettings")
+###############
+
+
+class RenderSettings(object):
+    """
+    Frozen snapshot of config values read in drawing and input
+    handling. Config makes a new snapshot with a higher version only
+    when one of the values actually changed, so hot paths can hold on
+    to a snapshot and compare a single integer to know whether what
+    they cached is still valid.
+    """
+
+    # snapshot attribute, path below the config object
+    FIELDS = (
+        ("key_width",          "keyboard.key_width"),
+        ("key_hit_hysteresis", "keyboard.key_hit_hysteresis"),
+        ("long_press_delay",   "keyboard.long_press_delay"),
+        ("touch_input",        "keyboard.touch_input"),
+        ("roundrect_radius",   "theme_settings.roundrect_radius"),
+        ("key_label_font",     "theme_settings.key_label_font"),
+    )
+
+    __slots__ = ("version", "_values") + tuple(name for name, path in FIELDS)
+
+    def __init__(self, version, values):
+        set_attr = object.__setattr__
+        set_attr(self, "version", version)
+        set_attr(self, "_values", tuple(values))
+        for (name, path), value in zip(self.FIELDS, values):
+            set_attr(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RenderSettings are read-only")
+
+    def __repr__(self):
+        return "{}({}, {})".format(type(self).__name__, self.version,
+                    ", ".join("{}={!r}".format(name, getattr(self, name)) \
+                              for name, path in self.FIELDS))
+
+    @classmethod
+    def read_values(cls, config):
+        """ Current values of all fields in FIELDS order """
+        values = []
+        for name, path in cls.FIELDS:
+            obj = config
+            for attr in path.split("."):
+                obj = getattr(obj, attr)
+            values.append(obj)
+        return tuple(values)
+
+    def get_values(self):
+        return self._values
+
+    def get_changes(self, other):
+        """ Names of the fields that differ from snapshot other """
+        if other is None:
+            return [name for name, path in self.FIELDS]
+        return [name for (name, path), a, b in \
+                zip(self.FIELDS, self._values, other._values) if a != b]
+
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+""" Headless replay of touch input for benchmarks and regression checks """
+
+from __future__ import division, print_function, unicode_literals
+
+import json
+import time
+import random
+
+import cairo
+
+from ChordKey.utils               import Rect
+from ChordKey.TouchInput          import InputSequence
+from ChordKey.Keyboard            import TypeAction
+from ChordKey                     import KeyCommon
+from ChordKey.KeySynth            import KeySynthRecorder
+from ChordKey.ChordKeyboardWidget import ChordKeyboardWidget
+
+### Logging ###
+import logging
+_logger = logging.getLogger("Replay")
+###############
+
+### Config Singleton ###
+from ChordKey.Config import get_config
+config = get_config()
+########################
+
+
+class ReplayKeyboardWidget(ChordKeyboardWidget):
+    """
+    Keyboard widget that is never shown. It has a fixed size,
+    no window to move or resize and collects damage rects
+    instead of queuing redraws.
+    """
+
+    def __init__(self, keyboard, width, height):
+        self._width = width
+        self._height = height
+        self.damage = []
+        ChordKeyboardWidget.__init__(self, keyboard)
+        self.update_layout()
+
+    def init_event_handling(self, use_gtk, use_raw_events):
+        # all input comes from the replay driver
+        self._device_manager = None
+
+    def get_allocated_width(self):
+        return self._width
+
+    def get_allocated_height(self):
+        return self._height
+
+    def get_frame_width(self):
+        return 0.0
+
+    def get_kbd_window(self):
+        return None
+
+    def on_layout_updated(self):
+        pass
+
+    def hit_test_move_resize(self, point):
+        return None
+
+    def queue_draw(self):
+        self.damage.append(self.canvas_rect)
+
+    def queue_draw_area(self, x, y, w, h):
+        self.damage.append(Rect(x, y, w, h))
+
+    def draw_damage(self, context):
+        """ Paint and forget all damaged rects, like a frame would. """
+        for rect in self.damage:
+            context.save()
+            context.rectangle(*rect)
+            context.clip()
+            self.draw_keyboard(context, rect)
+            context.restore()
+        self.damage = []
+
+
+class ReplayDriver:
+    """
+    Feeds streams of touch events through the input sequence handling
+    of a widget. Events are (type, sequence id, x, y, time) tuples with
+    type "begin", "update", "end" or "cancel" and time in ms.
+    """
+
+    def __init__(self, widget, draw = False):
+        self.widget = widget
+        self.num_events = 0
+        self._sequences = {}
+        self._surface = None
+        self._context = None
+        if draw:
+            self._surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                    int(widget.get_allocated_width()),
+                                    int(widget.get_allocated_height()))
+            self._context = cairo.Context(self._surface)
+
+    def run(self, events):
+        for event in events:
+            self.feed(*event)
+
+    def feed(self, type, id, x, y, event_time):
+        widget = self.widget
+        if type == "begin":
+            sequence = InputSequence()
+            sequence.id = id
+            sequence.button = 1
+            sequence.primary = not self._sequences
+            self._update_sequence(sequence, x, y, event_time)
+            self._sequences[id] = sequence
+            widget._input_sequence_begin(sequence)
+        else:
+            sequence = self._sequences.get(id)
+            if sequence is None:
+                _logger.warning("replay event for unknown sequence {}" \
+                                .format(id))
+                return
+            self._update_sequence(sequence, x, y, event_time)
+            if type == "update":
+                widget._input_sequence_update(sequence)
+            else:
+                del self._sequences[id]
+                widget._input_sequence_end(sequence)
+
+        # no main loop here, send key strokes like an idle callback would
+        widget.keyboard.flush_key_synth()
+
+        if self._context:
+            widget.draw_damage(self._context)
+        else:
+            widget.damage = []
+        self.num_events += 1
+
+    @staticmethod
+    def _update_sequence(sequence, x, y, event_time):
+        sequence.point = (x, y)
+        sequence.root_point = (x, y)
+        sequence.time = event_time
+        sequence.updated = time.time()
+
+
+def create_replay_widget(keyboard, width = None, height = 200):
+    """
+    Widget for keyboard, with a KeySynthRecorder receiving its key strokes.
+    The default width leaves a gap of a few keys between both sides.
+    """
+    keyboard.set_key_synth(KeySynthRecorder())
+    if width is None:
+        width = (keyboard.left_cols + keyboard.right_cols + 3) * \
+                config.keyboard.key_width
+    return ReplayKeyboardWidget(keyboard, width, height)
+
+
+def load_event_log(filename):
+    """
+    Events exported by TouchInput's EventLog. The log has no
+    motion events, a stream of begin and end events is returned.
+    """
+    with open(filename) as f:
+        records = json.load(f)["events"]
+    return [(r["type"], r["sequence"], r["x"], r["y"], r["time"]) \
+            for r in records]
+
+
+def generate_mapping(keyboard, labels = None):
+    """
+    Mapping with a character for every key and every
+    ordered pair of keys of the keyboard's key grid.
+    """
+    dim = keyboard.dimensions()
+    keys = [(side, col, row) \
+            for side, cols in enumerate((dim.left_cols, dim.right_cols)) \
+            for col in range(cols) \
+            for row in range(dim.rows)]
+    key_seqs = [(key,) for key in keys] + \
+               [(k1, k2) for k1 in keys for k2 in keys if k1 != k2]
+
+    if labels is None:
+        labels = [chr(c) for c in range(0x21, 0x7f)]
+    mapping = {}
+    for i, key_seq in enumerate(key_seqs):
+        mapping[key_seq] = keyboard.char_action(labels[i % len(labels)])
+    return mapping
+
+
+def generate_chord_stream(widget, count, seed = 0):
+    """
+    Events typing count random chords of one or two keys, and
+    the text they are expected to type. Only plain character chords
+    are used, so the expected text doesn't depend on modifiers.
+    """
+    keyboard = widget.keyboard
+    chords = sorted(key_seq for key_seq, action in keyboard.mapping.items() \
+                    if len(key_seq) <= 2 and \
+                       isinstance(action, TypeAction) and \
+                       action.key_type == KeyCommon.CHAR_TYPE and \
+                       not action.mods and \
+                       widget.get_key_center(key_seq[0]) and \
+                       widget.get_key_center(key_seq[-1]))
+    rnd = random.Random(seed)
+    events = []
+    text = []
+    t = 0
+    for i in range(count):
+        key_seq = rnd.choice(chords)
+        ids = ["{}.{}".format(i, j) for j in range(len(key_seq))]
+        points = [widget.get_key_center(key) for key in key_seq]
+
+        # press in chord order, release in reverse order
+        for id, (x, y) in zip(ids, points):
+            events.append(("begin", id, x, y, t))
+            t += 8
+        for id, (x, y) in zip(ids, points):
+            events.append(("update", id, x + 1, y + 1, t))
+            t += 8
+        for id, (x, y) in reversed(list(zip(ids, points))):
+            events.append(("end", id, x + 1, y + 1, t))
+            t += 8
+
+        text.append(keyboard.mapping[key_seq].code)
+        t += 50
+    return events, "".join(text)
+
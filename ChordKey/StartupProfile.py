@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+""" Timeline of startup phases, printed with --profile-startup """
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+
+from ChordKey.utils import monotonic
+
+### Logging ###
+import logging
+_logger = logging.getLogger("StartupProfile")
+###############
+
+
+class StartupProfile:
+    """
+    Records when each startup phase finished. Only the first mark
+    of a phase counts, later ones are cheap no-ops, so marks may sit
+    in code that runs for every frame.
+    """
+
+    def __init__(self):
+        self._start = monotonic()
+        self._process_age = self._get_process_age()
+        self._phases = []
+        self._marked = set()
+        self.finished = False
+
+    def mark(self, phase):
+        """ phase has just finished """
+        if self.finished or phase in self._marked:
+            return
+        self._marked.add(phase)
+        self._phases.append((phase, monotonic()))
+
+    def finish(self, print_timeline = False):
+        """ Stop recording, optionally print the timeline. """
+        if self.finished:
+            return
+        self.finished = True
+        if print_timeline:
+            self.print_timeline()
+
+    def get_timeline(self):
+        """
+        [(phase, ms since start, ms since previous phase)].
+        Start is when the process was started if known, else
+        when this profile was created.
+        """
+        offset = (self._process_age or 0.0) * 1000.0
+        timeline = []
+        if self._process_age is not None:
+            timeline.append(("interpreter", offset, offset))
+        last = self._start
+        for phase, t in self._phases:
+            timeline.append((phase,
+                             (t - self._start) * 1000.0 + offset,
+                             (t - last) * 1000.0))
+            last = t
+        return timeline
+
+    def print_timeline(self, file = None):
+        file = file or sys.stdout
+        print("startup timeline [ms]:", file = file)
+        print("  {:<24} {:>10} {:>10}".format("phase", "total", "delta"),
+              file = file)
+        for phase, total, delta in self.get_timeline():
+            print("  {:<24} {:>10.1f} {:>10.1f}".format(phase, total, delta),
+                  file = file)
+        file.flush()
+
+    @staticmethod
+    def _get_process_age():
+        """
+        Seconds since this process was started, so that interpreter
+        startup and early imports show up too. None where unknown.
+        """
+        try:
+            with open("/proc/self/stat") as f:
+                stat = f.read()
+            with open("/proc/uptime") as f:
+                uptime = float(f.read().split()[0])
+            # skip the command name, it may contain spaces
+            fields = stat[stat.rindex(")") + 2:].split()
+            start_ticks = int(fields[19])
+            return max(0.0, uptime - start_ticks /
+                                     os.sysconf(str("SC_CLK_TCK")))
+        except (IOError, OSError, ValueError, IndexError) as ex:
+            _logger.debug("process start time unavailable: {}".format(ex))
+            return None
+
+
+_profile = None
+
+def get_startup_profile():
+    global _profile
+    if _profile is None:
+        _profile = StartupProfile()
+    return _profile
+
@@ -114,8 +114,12 @@ class TouchHandle(object):
 
         self._rect = Rect(x, y, w, h)
 
+    def get_hit_rect(self):
+        """ Bounds of the area hit_test may return True for """
+        return self.get_rect().grow(self._hit_proximity_factor)
+
     def hit_test(self, point):
-        rect   = self.get_rect().grow(self._hit_proximity_factor)
+        rect   = self.get_hit_rect()
         radius = self.get_radius() * self._hit_proximity_factor
 
         if rect and rect.is_point_within(point):
@@ -4,11 +4,14 @@
 from __future__ import division, print_function, unicode_literals
 
 import time
+import json
+from collections import deque, OrderedDict
 
 from gi.repository         import Gdk
 
-from ChordKey.utils         import Timer
+from ChordKey.utils         import Timer, monotonic
 from ChordKey.XInput        import XIDeviceManager, XIEventType, XIEventMask
+from ChordKey.LatencyTracer import get_latency_tracer, LatencyStage
 
 ### Logging ###
 import logging
@@ -20,6 +23,8 @@ from ChordKey.Config import get_config
 config = get_config()
 ########################
 
+latency_tracer = get_latency_tracer()
+
 BUTTON123_MASK = Gdk.ModifierType.BUTTON1_MASK | \
                  Gdk.ModifierType.BUTTON2_MASK | \
                  Gdk.ModifierType.BUTTON3_MASK
@@ -50,7 +55,130 @@ class TouchInputEnum:
         MULTI,
     ) = range(3)
 
-evlog = []
+
+class EventRecord:
+    """ Compact copy of a touch event, Gdk events aren't kept alive. """
+    __slots__ = ("sequence", "type", "x", "y", "time", "received")
+
+    def __init__(self):
+        self.set(None, None, 0.0, 0.0, 0, 0.0)
+
+    def set(self, sequence, type, x, y, time, received):
+        self.sequence = sequence  # sequence id
+        self.type     = type      # "begin", "end" or "cancel"
+        self.x        = x
+        self.y        = y
+        self.time     = time      # event time [ms]
+        self.received = received  # monotonic receive time [s]
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class EventLog:
+    """
+    Fixed-capacity ring buffer of the most recent touch events.
+    Records are preallocated and overwritten in place, so memory stays
+    flat however long the session runs.
+    """
+    CAPACITY = 4096
+
+    def __init__(self, capacity = None):
+        self._records = [EventRecord() \
+                         for i in range(capacity or self.CAPACITY)]
+        self._total = 0
+
+    @property
+    def capacity(self):
+        return len(self._records)
+
+    @property
+    def dropped(self):
+        """ Number of records overwritten since the last clear """
+        return max(0, self._total - self.capacity)
+
+    def __len__(self):
+        return min(self._total, self.capacity)
+
+    def append(self, sequence, type, x, y, time, received = None):
+        if received is None:
+            received = monotonic()
+        record = self._records[self._total % self.capacity]
+        record.set(sequence, type, x, y, time, received)
+        self._total += 1
+
+    def clear(self):
+        self._total = 0
+
+    def snapshot(self):
+        """ Copies of the logged events as dicts, oldest first. """
+        n = len(self)
+        start = self._total - n
+        capacity = self.capacity
+        return [self._records[(start + i) % capacity].as_dict() \
+                for i in range(n)]
+
+    def export(self, filename):
+        """ Write the snapshot to filename as JSON. """
+        with open(filename, "w") as f:
+            json.dump({"dropped" : self.dropped,
+                       "events"  : self.snapshot()},
+                      f, indent = 1)
+
+evlog = EventLog()
+
+class ReleaseOrderWindow:
+    """
+    How long a touch release may wait for other fingers of the chord.
+    Learned from the skew between finger releases observed so far,
+    50 ms until there are enough samples.
+    """
+    DEFAULT_WINDOW = 0.05   # [s]
+    MIN_WINDOW     = 0.015  # [s]
+    MAX_WINDOW     = 0.08   # [s]
+    MAX_SKEW       = 200    # [ms] releases further apart aren't a chord
+    MIN_SAMPLES    = 8
+    MAX_SAMPLES    = 64
+    PERCENTILE     = 0.9
+    MARGIN         = 1.25
+
+    def __init__(self):
+        self._samples = deque(maxlen = self.MAX_SAMPLES)
+        self._window = self.DEFAULT_WINDOW
+        self._last_release_time = None
+        self._last_release_partners = ()
+
+    def get_window(self):
+        """ Current release window in seconds """
+        return self._window
+
+    def observe_release(self, sequence, active_ids):
+        """
+        Record the release of sequence while active_ids were in flight.
+        Its skew to the previous release is a sample if both fingers
+        were down at the same time.
+        """
+        if self._last_release_time is not None and \
+           sequence.id in self._last_release_partners:
+            skew = abs(sequence.time - self._last_release_time)
+            if skew <= self.MAX_SKEW:
+                self.add_sample(skew)
+
+        self._last_release_time = sequence.time
+        self._last_release_partners = \
+                [id for id in active_ids if id != sequence.id]
+
+    def add_sample(self, skew):
+        """ Release skew in ms """
+        self._samples.append(skew)
+        if len(self._samples) >= self.MIN_SAMPLES:
+            samples = sorted(self._samples)
+            index = min(len(samples) - 1,
+                        int(len(samples) * self.PERCENTILE))
+            window = samples[index] * self.MARGIN / 1000.0
+            self._window = max(self.MIN_WINDOW,
+                               min(self.MAX_WINDOW, window))
+
 
 class InputSequence:
     """
@@ -117,8 +245,9 @@ class TouchInput:
     def __init__(self):
         self._input_sequences = {}
         self._touch_events_enabled = self.is_touch_enabled()
-        self._multi_touch_enabled  = config.keyboard.touch_input == \
-                                     TouchInputEnum.MULTI
+        self._multi_touch_enabled  = \
+                     config.get_render_settings().touch_input == \
+                     TouchInputEnum.MULTI
         self._gestures_enabled     = self._touch_events_enabled
         self._last_event_was_touch = False
         self._last_sequence_time = 0
@@ -132,19 +261,30 @@ class TouchInput:
         self._gesture_timer = Timer()
 
         self._order_timer = Timer()
-        self._queued_events = []
+        self._release_window = ReleaseOrderWindow()
+        self._queued_releases = []
+
+        self._pending_updates = OrderedDict()
+        self._update_tick_id = None
+
+        self._selected_devices = {}
+        self._xi_event_mask = 0
 
         self.init_event_handling(
                  config.keyboard.event_handling == EventHandlingEnum.GTK,
                  False)
 
-        self._pytime_start = None
-        self._evtime_start = None
 
     def cleanup(self):
+        self._flush_sequence_updates()
         if self._device_manager:
-            self._device_manager.disconnect("device-event",
-                                            self._device_event_handler)
+            self._device_manager.disconnect("device-added",
+                                            self._on_device_added)
+            self._device_manager.disconnect("device-removed",
+                                            self._on_device_removed)
+            for device in self._selected_devices.values():
+                device.unselect_events()
+            self._selected_devices = {}
             self._device_manager = None
 
     def init_event_handling(self, use_gtk, use_raw_events):
@@ -169,8 +309,10 @@ class TouchInput:
         else:
             # XInput event handling
             self._device_manager = XIDeviceManager()
-            self._device_manager.connect("device-event",
-                                         self._device_event_handler)
+            self._device_manager.connect("device-added",
+                                         self._on_device_added)
+            self._device_manager.connect("device-removed",
+                                         self._on_device_removed)
 
             devices = self._device_manager.get_slave_pointer_devices()
             _logger.warning("listening to XInput devices: {}" \
@@ -191,20 +333,37 @@ class TouchInput:
                 if self._touch_events_enabled:
                     event_mask |= XIEventMask.TouchMask
 
+            self._xi_event_mask = event_mask
+            self._selected_devices = {}
             for device in devices:
-                device.select_events(event_mask)
+                self._select_device(device)
 
-            self._selected_devices = devices
-            self._selected_device_ids = [d.id for d in devices]
             self._use_raw_events = use_raw_events
 
-    def _device_event_handler(self, event):
+    def _select_device(self, device):
         """
-        Handler for XI2 events.
+        Events of selected devices are dispatched straight to
+        _device_event_handler by the device manager.
         """
-        if not event.device_id in self._selected_device_ids:
-            return
+        device.select_events(self._xi_event_mask, self._device_event_handler)
+        self._selected_devices[device.id] = device
+
+    def _on_device_added(self, device):
+        if device.is_pointer() and not device.is_master():
+            _logger.warning("listening to added XInput device: {}" \
+                            .format((device.name, device.id,
+                                     device.get_config_string())))
+            self._select_device(device)
 
+    def _on_device_removed(self, device):
+        if self._selected_devices.pop(device.id, None):
+            _logger.warning("XInput device removed: {}" \
+                            .format((device.name, device.id)))
+
+    def _device_event_handler(self, event):
+        """
+        Handler for XI2 events of the selected devices.
+        """
         #print("device {}, xi_type {}, type {}, point {} {}, xid {}" \
          #     .format(event.device_id, event.xi_type, event.type, event.x, event.y, event.xid_event))
 
@@ -260,7 +419,8 @@ class TouchInput:
                 self._on_touch_event(self, event)
 
     def is_touch_enabled(self):
-        return config.keyboard.touch_input != TouchInputEnum.NONE
+        return config.get_render_settings().touch_input != \
+               TouchInputEnum.NONE
 
     def has_input_sequences(self):
         """ Are any clicks/touches still ongoing? """
@@ -299,7 +459,7 @@ class TouchInput:
         sequence.init_from_motion_event(event)
 
         self._last_event_was_touch = False
-        self._input_sequence_update(sequence)
+        self._queue_sequence_update(sequence)
 
     def _on_button_release_event(self, widget, event):
         sequence = self._input_sequences.get(POINTER_SEQUENCE)
@@ -320,22 +480,13 @@ class TouchInput:
 
         event_type = event.type
         if event_type == Gdk.EventType.TOUCH_BEGIN:
-            if self._pytime_start == None:
-                self._pytime_start = time.time()
-                self._evtime_start = event.get_time()
-            #print("DOWN",time.time()-self._pytime_start,event.get_time()-self._evtime_start)
-            evlog.append(event)
+            evlog.append(id, "begin", touch.x, touch.y, event.get_time())
             sequence = InputSequence()
             sequence.init_from_touch_event(touch, id)
             if len(self._input_sequences) == 0:
                 sequence.primary = True
-            for ev, qseq in self._queued_events:
-                if qseq.time < event.get_time():
-                    #print("Yielded to queued")
-                    self._input_sequence_end(qseq)
-                    self._queued_events.remove((ev, qseq))
 
-            
+            self._release_settled(event.get_time())
             self._input_sequence_begin(sequence)
 
         elif event_type == Gdk.EventType.TOUCH_UPDATE:
@@ -346,7 +497,8 @@ class TouchInput:
                 sequence.time       = event.get_time()
                 sequence.updated    = time.time()
 
-                self._input_sequence_update(sequence)
+                self._release_settled(sequence.time)
+                self._queue_sequence_update(sequence)
 
         else:
             if event_type == Gdk.EventType.TOUCH_END:
@@ -355,27 +507,102 @@ class TouchInput:
             elif event_type == Gdk.EventType.TOUCH_CANCEL:
                 pass
 
-            #print("UP",time.time()-self._pytime_start,event.get_time()-self._evtime_start)
-            evlog.append(event)
+            latency_tracer.begin(event.get_time())
+            evlog.append(id,
+                         "end" if event_type == Gdk.EventType.TOUCH_END \
+                         else "cancel",
+                         touch.x, touch.y, event.get_time())
             sequence = self._input_sequences.get(id)
             if not sequence is None:
                 sequence.time       = event.get_time()
-                self._queued_events.append((Gdk.EventType.TOUCH_END,sequence))
-                self._order_timer.start(0.05,self._delayed_release)
+                self._queue_release(sequence)
+
+    def _queue_release(self, sequence):
+        """
+        Touch releases decide the chord order, but events of different
+        fingers may arrive out of order. Releases are committed as soon
+        as their order is settled, otherwise after a short window.
+        """
+        self._release_settled(sequence.time)
+        self._release_window.observe_release(sequence,
+                                             self._input_sequences.keys())
+        self._queued_releases.append(sequence)
+
+        queued_ids = set(seq.id for seq in self._queued_releases)
+        if all(id in queued_ids for id in self._input_sequences):
+            # No other touch is in flight, nothing can reorder them.
+            self._release_queued()
+        elif not self._order_timer.is_running():
+            self._order_timer.start(self._release_window.get_window(),
+                                    self._delayed_release)
+
+    def _release_settled(self, event_time):
+        """
+        End queued sequences released before event_time. An event
+        with a later timestamp arrived, so their order can't change.
+        """
+        queued = self._queued_releases
+        if queued:
+            settled = [seq for seq in queued if seq.time < event_time]
+            if settled:
+                self._queued_releases = [seq for seq in queued \
+                                         if seq.time >= event_time]
+                if not self._queued_releases:
+                    self._order_timer.stop()
+                self._end_sequences(settled)
+
+    def _release_queued(self):
+        self._order_timer.stop()
+        queued = self._queued_releases
+        self._queued_releases = []
+        self._end_sequences(queued)
+
+    def _end_sequences(self, sequences):
+        """ End sequences in the order they were released. """
+        for seq in sorted(sequences, key = lambda seq: seq.time):
+            self._input_sequence_end(seq)
 
     def _delayed_release(self):
-        for ev, seq in self._queued_events:
-            if ev ==  Gdk.EventType.TOUCH_END:
-                #print("D:UP",time.time()-self._pytime_start,seq.time-self._evtime_start)
-                self._input_sequence_end(seq)
-            #elif ev ==  Gdk.EventType.TOUCH_BEGIN:
-        self._queued_events.clear()
+        self._release_queued()
         return False
 
+    def _queue_sequence_update(self, sequence):
+        """
+        Motion is coalesced and delivered once per frame, only the
+        latest point of each sequence counts. Digitizers may report
+        far more often than we could redraw.
+        """
+        self._pending_updates[sequence.id] = sequence
+        if self._update_tick_id is None:
+            if self.get_mapped():
+                self._update_tick_id = \
+                    self.add_tick_callback(self._on_update_tick, None)
+            else:
+                self._flush_sequence_updates()
+
+    def _on_update_tick(self, widget, frame_clock, user_data):
+        self._update_tick_id = None
+        self._flush_sequence_updates()
+        return False
 
+    def _flush_sequence_updates(self):
+        """
+        Deliver pending motion now. Called before every begin
+        and end, so those are never reordered with motion.
+        """
+        if self._update_tick_id is not None:
+            self.remove_tick_callback(self._update_tick_id)
+            self._update_tick_id = None
+
+        pending = self._pending_updates
+        if pending:
+            self._pending_updates = OrderedDict()
+            for sequence in pending.values():
+                self._input_sequence_update(sequence)
 
     def _input_sequence_begin(self, sequence):
         """ Button press/touch begin """
+        self._flush_sequence_updates()
         self._gesture_sequence_begin(sequence)
         first_sequence = len(self._input_sequences) == 0
 
@@ -422,6 +649,7 @@ class TouchInput:
 
     def _input_sequence_end(self, sequence):
         """ Button release/touch end """
+        self._flush_sequence_updates()
         self._gesture_sequence_end(sequence)
         self._gesture_timer.finish()  # run delayed sequence before end
         if sequence.id in self._input_sequences:
@@ -429,6 +657,7 @@ class TouchInput:
 
             if sequence.delivered:
                 self._gesture_timer.finish()  # run delayed sequence before end
+                latency_tracer.mark(LatencyStage.SEQUENCE_END)
                 self.on_input_sequence_end(sequence)
 
         if self._input_sequences:
@@ -23,7 +23,7 @@ from gi.repository import Gdk
 
 from Onboard.utils import EventSource
 
-import Onboard.osk as osk
+import ChordKey.osk as osk
 
 import logging
 logger = logging.getLogger(__name__)
@@ -139,7 +139,9 @@ class XIDeviceManager(EventSource):
         """
         Singleton constructor, runs only once.
         """
-        EventSource.__init__(self, ["device-event"])
+        EventSource.__init__(self, ["device-event",
+                                    "device-added",
+                                    "device-removed"])
 
         self._devices = {}
 
@@ -170,47 +172,101 @@ class XIDeviceManager(EventSource):
                 if device.is_master()]
 
     def update_devices(self):
+        """ Enumerate all devices, only needed on startup. """
         devices = {}
         for info in self._osk_devices.list():
-            device = XIDevice()
-            device._device_manager = self
-            (
-                device.name,
-                device.id,
-                device.use,
-                device.master,
-                device.enabled,
-                device.vendor,
-                device.product,
-                touch_mode,
-            ) = info
-            device.source = XIDevice.classify_source(device.name, device.use,
-                                                      touch_mode)
-            if not device.name in self.blacklist:
+            device = self._new_device(info)
+            if device:
                 devices[device.id] = device
 
         self._devices = devices
 
-    def select_events(self, device, mask):
+    def _new_device(self, info):
+        device = XIDevice()
+        device._device_manager = self
+        (
+            device.name,
+            device.id,
+            device.use,
+            device.master,
+            device.enabled,
+            device.vendor,
+            device.product,
+        ) = info[:7]
+        # older osk modules don't report the touch mode
+        touch_mode = info[7] if len(info) > 7 else 0
+        device.source = XIDevice.classify_source(device.name, device.use,
+                                                  touch_mode)
+        if device.name in self.blacklist:
+            return None
+        return device
+
+    def _add_device(self, device_id):
+        """ Hotplug: register a single new device. """
+        try:
+            info = self._osk_devices.get_info(device_id)
+            device = self._new_device(info)
+        except (osk.error, ValueError, TypeError) as ex:
+            logger.warning("failed to get info for device {}: {}" \
+                           .format(device_id, ex))
+            return
+        if device:
+            self._devices[device.id] = device
+            self.emit("device-added", device)
+
+    def _remove_device(self, device_id):
+        """ Hotplug: drop a single device. """
+        device = self._devices.pop(device_id, None)
+        if device:
+            device.selected_mask = 0
+            device.event_handler = None
+            self.emit("device-removed", device)
+
+    def select_events(self, device, mask, event_handler = None):
+        """
+        Select XI events of device. Events of devices with an event
+        handler are dispatched directly to it, bypassing "device-event".
+        """
         self._osk_devices.select_events(device.id, mask)
+        device.selected_mask = mask
+        device.event_handler = event_handler
 
     def unselect_events(self, device):
         self._osk_devices.unselect_events(device.id)
+        device.selected_mask = 0
+        device.event_handler = None
 
     def _device_event_handler(self, event):
         """
-        Handler Handlerfor XI2 events.
+        Handler for XI2 events.
         """
-        device = self.lookup_device_id(event.device_id)
-        if not device:
+        xi_type = event.xi_type
+        if xi_type == XIEventType.DeviceAdded:
+            self._add_device(event.device_id)
+            return
+        if xi_type == XIEventType.DeviceRemoved:
+            self._remove_device(event.device_id)
             return
 
-        source_device = self.lookup_device_id(event.source_id)
-        if not source_device:
+        device = self._devices.get(event.device_id)
+        if not device:
             return
+
+        # Slave devices are usually their own source,
+        # the common case for touch screens.
+        if event.source_id == device.id:
+            source_device = device
+        else:
+            source_device = self._devices.get(event.source_id)
+            if not source_device:
+                return
         event.set_source_device(source_device)
 
-        self.emit("device-event", event)
+        handler = device.event_handler
+        if handler:
+            handler(event)
+        else:
+            self.emit("device-event", event)
 
 
 class XIDevice(object):
@@ -226,10 +282,13 @@ class XIDevice(object):
     product      = None
     source       = None
 
+    selected_mask = 0        # XI event mask selected for this device
+    event_handler = None     # receives selected events, if set
+
     _device_manager = None
 
-    def select_events(self, mask):
-        self._device_manager.select_events(self, mask)
+    def select_events(self, mask, event_handler = None):
+        self._device_manager.select_events(self, mask, event_handler)
 
     def unselect_events(self):
         self._device_manager.unselect_events(self)
@@ -924,6 +924,7 @@ error:
  * 4: enabled (bool)
  * 5: vendor id (int)
  * 6: product id (int)
+ * 7: touch mode (int)
  *
  * Returns: A device info tuple.
  */
@@ -951,13 +952,15 @@ osk_devices_get_info (PyObject *self, PyObject *args)
 
     osk_devices_get_product_id (dev, id, &vid, &pid);
 
-    value = Py_BuildValue ("(siiiBii)",
+    value = Py_BuildValue ("(siiiBiii)",
                            devices[0].name,
                            devices[0].deviceid,
                            devices[0].use,
                            devices[0].attachment,
                            devices[0].enabled,
-                           vid, pid);
+                           vid, pid,
+                           get_touch_mode(devices[0].classes,
+                                          devices[0].num_classes));
 
     XIFreeDeviceInfo (devices);
 
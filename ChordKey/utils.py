@@ -21,6 +21,11 @@ from functools import reduce
 _logger = logging.getLogger("utils")
 ###############
 
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2
+    monotonic = time.time
+
 
 class Modifiers:
     # 1      2     4    8    16     32    64     128
@@ -456,6 +461,7 @@ class Rect:
     """
 
     attributes = ("x", "y", "w", "h")
+    __slots__ = attributes
 
     def __init__(self, x = 0, y = 0, w = 0, h = 0):
         self.x = x
@@ -466,9 +472,13 @@ class Rect:
     def __len__(self):
         return 4
 
+    def __iter__(self):
+        """ Unpacking with '*' operator, without per-item lookups """
+        return iter((self.x, self.y, self.w, self.h))
+
     def __getitem__(self, index):
-        """ Collection interface for rvalues, unpacking with '*' operator """
-        return getattr(self, self.attributes[index])
+        """ Collection interface for rvalues """
+        return (self.x, self.y, self.w, self.h)[index]
 
     def __setitem__(self, index, value):
         """ Collection interface for lvalues """
@@ -551,12 +561,17 @@ class Rect:
     def left_top(self):
         return self.x, self.y
 
-    def is_point_within(self, point):
-        """ True, if the given point lies inside the rectangle """
-        if self.x <= point[0] and \
-           self.x + self.w > point[0] and \
-           self.y <= point[1] and \
-           self.y + self.h > point[1]:
+    def is_point_within(self, point, margin = 0):
+        """
+        True, if the given point lies inside the rectangle,
+        inflated by margin on all sides.
+        """
+        x = point[0]
+        y = point[1]
+        if self.x - margin <= x and \
+           self.x + self.w + margin > x and \
+           self.y - margin <= y and \
+           self.y + self.h + margin > y:
             return True
         return False
 
@@ -704,6 +719,46 @@ class Rect:
         return rects
 
 
+def merge_adjacent_rects(rects, epsilon = 1e-3):
+    """
+    Merge rectangles that share a complete edge. Their union covers
+    exactly the same area, so nothing extra is queued for redrawing.
+
+    Doctests:
+    >>> [str(r) for r in merge_adjacent_rects([Rect(0, 0, 1, 1),
+    ...                                        Rect(1, 0, 1, 1)])]
+    ['Rect(x=0 y=0 w=2 h=1)']
+    >>> [str(r) for r in merge_adjacent_rects([Rect(0, 0, 1, 1),
+    ...                                        Rect(0, 1, 1, 1),
+    ...                                        Rect(1, 0, 1, 2)])]
+    ['Rect(x=0 y=0 w=2 h=2)']
+    >>> len(merge_adjacent_rects([Rect(0, 0, 1, 1), Rect(1, 1, 1, 1)]))
+    2
+    """
+    def close(a, b):
+        return abs(a - b) < epsilon
+
+    rects = list(rects)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            a = rects[i]
+            for j in range(i + 1, len(rects)):
+                b = rects[j]
+                if close(a.y, b.y) and close(a.h, b.h) and \
+                   (close(a.x + a.w, b.x) or close(b.x + b.w, a.x)) or \
+                   close(a.x, b.x) and close(a.w, b.w) and \
+                   (close(a.y + a.h, b.y) or close(b.y + b.h, a.y)):
+                    rects[i] = a.union(b)
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+
 def brighten(amount, r, g, b, a=0.0):
     """ Make the given color brighter by amount a [-1.0...1.0] """
     h, l, s = colorsys.rgb_to_hls(r, g, b)